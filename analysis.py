@@ -1,9 +1,13 @@
-import requests
+import argparse
+import asyncio
+import importlib.util
+import httpx
 import pandas as pd
 import time
 import os
+from collections import deque
 from dotenv import load_dotenv
-from datetime import datetime
+from dateutil import tz
 
 # --- CONFIGURATION ---
 load_dotenv()
@@ -15,124 +19,211 @@ HEADERS = {
     "X-Riot-Token": API_KEY
 }
 
+# Riot development-key limits as (max requests, window in seconds)
+RATE_LIMITS = ((20, 1), (100, 120))
+# Upper bound on match-detail requests in flight at once
+MAX_CONCURRENT_REQUESTS = 20
+
+# Participant fields kept from each match document
+PARTICIPANT_FIELDS = ("puuid", "win", "championName", "teamPosition")
+
+# Parquet engines pandas can write with; one must be installed unless --csv is passed
+PARQUET_ENGINES = ("pyarrow", "fastparquet")
+# Low-cardinality columns stored as categories so Parquet dictionary-encodes them
+CATEGORY_COLUMNS = ["champion", "role", "outcome", "day_of_week"]
+
 # --- HELPER FUNCTIONS ---
 
-def get_puuid(game_name: str, tag_line: str, region: str = "europe") -> str | None:
+class RateLimiter:
+    """Sliding-window limiter that lets concurrent requests run as fast as the rate limits allow."""
+
+    def __init__(self, limits=RATE_LIMITS):
+        self._limits = limits
+        self._timestamps = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = max(
+                    (self._timestamps[-count] + window - now
+                     for count, window in self._limits if len(self._timestamps) >= count),
+                    default=0,
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self._timestamps.append(now)
+            longest_window = max(window for _, window in self._limits)
+            while self._timestamps[0] <= now - longest_window:
+                self._timestamps.popleft()
+
+_limiter = RateLimiter()
+
+async def _get(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    """Rate-limited GET that waits out HTTP 429 responses using Retry-After."""
+    while True:
+        await _limiter.acquire()
+        response = await client.get(url)
+        if response.status_code != 429:
+            response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
+            return response
+        await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+
+async def get_puuid(client: httpx.AsyncClient, game_name: str, tag_line: str, region: str = "europe") -> str | None:
     """Fetches the PUUID for a given Riot ID."""
     url = f"https://{region}.api.riotgames.com/riot/account/v1/accounts/by-riot-id/{game_name}/{tag_line}"
     try:
-        response = requests.get(url, headers=HEADERS)
-        response.raise_for_status() # Raises an HTTPError for bad responses (4xx or 5xx)
+        response = await _get(client, url)
         return response.json()['puuid']
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error fetching PUUID: {e}")
         return None
 
-def get_match_ids(puuid: str, count: int, start_index: int, region: str = "europe") -> list | None:
+async def get_match_ids(client: httpx.AsyncClient, puuid: str, count: int, start_index: int, region: str = "europe") -> list | None:
     """Fetches a list of match IDs for a given PUUID, starting from a specific index."""
     url = f"https://{region}.api.riotgames.com/lol/match/v5/matches/by-puuid/{puuid}/ids?queue=420&start={start_index}&count={count}"
     try:
-        response = requests.get(url, headers=HEADERS)
-        response.raise_for_status()
+        response = await _get(client, url)
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error fetching match IDs: {e}")
         return None
 
-def get_match_details(match_id: str, puuid: str, region: str = "europe") -> dict | None:
-    """Fetches details for a single match and extracts relevant player data."""
+async def get_match_json(client: httpx.AsyncClient, match_id: str, region: str = "europe") -> dict | None:
+    """Fetches a single match and keeps only the fields needed to build the dataset."""
     url = f"https://{region}.api.riotgames.com/lol/match/v5/matches/{match_id}"
     try:
-        response = requests.get(url, headers=HEADERS)
-        response.raise_for_status()
+        response = await _get(client, url)
         data = response.json()
-        
-        # Find the specific player's data in the participants list
-        player_data = next((p for p in data['info']['participants'] if p['puuid'] == puuid), None)
-        
-        if player_data:
-            # Game timestamp is in milliseconds, convert to a readable format
-            game_timestamp = data['info']['gameCreation'] / 1000
-            game_datetime = datetime.fromtimestamp(game_timestamp)
-
-            return {
-                "match_id": match_id,
-                "timestamp": game_datetime,
-                "date": game_datetime.strftime('%Y-%m-%d'),
-                "time_start": game_datetime.strftime('%H:%M:%S'),
-                "day_of_week": game_datetime.strftime('%A'),
-                "outcome": "Win" if player_data['win'] else "Loss",
-                "champion": player_data['championName'],
-                "role": player_data['teamPosition']
-            }
-        return None
-    except requests.exceptions.RequestException as e:
+        # Drop everything else in the (large) match document right away
+        return {
+            "matchId": data['metadata']['matchId'],
+            "gameCreation": data['info']['gameCreation'],
+            "participants": [
+                {field: p[field] for field in PARTICIPANT_FIELDS}
+                for p in data['info']['participants']
+            ],
+        }
+    except httpx.HTTPError as e:
         print(f"Error fetching details for match {match_id}: {e}")
         return None
+    except (KeyError, TypeError) as e:
+        print(f"Unexpected data for match {match_id}: {e}")
+        return None
 
+async def fetch_all(client: httpx.AsyncClient, match_ids: list[str], region: str) -> list[dict]:
+    """Fetches all matches concurrently; the rate limiter decides the actual pace."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    completed = 0
 
-if __name__ == "__main__":
+    async def bounded(match_id: str) -> dict | None:
+        nonlocal completed
+        async with semaphore:
+            match_json = await get_match_json(client, match_id, region)
+        completed += 1
+        # Provide progress feedback to the user
+        print(f"Processed match {completed}/{len(match_ids)}...")
+        return match_json
+
+    results = await asyncio.gather(*(bounded(mid) for mid in match_ids))
+    return [r for r in results if r]
+
+def build_history_frame(raw_matches: list[dict], puuid: str) -> pd.DataFrame:
+    """Extracts the player's row from every match in one vectorized pass."""
+    participants = pd.json_normalize(
+        raw_matches, record_path='participants', meta=['matchId', 'gameCreation']
+    )
+    mine = participants[participants['puuid'] == puuid]
+
+    # Game timestamp is in milliseconds; convert to local wall-clock time
+    game_datetime = (
+        pd.to_datetime(mine['gameCreation'].astype('int64'), unit='ms', utc=True)
+        .dt.tz_convert(tz.tzlocal())
+        .dt.tz_localize(None)
+    )
+
+    return pd.DataFrame({
+        "match_id": mine['matchId'],
+        "timestamp": game_datetime,
+        "date": game_datetime.dt.strftime('%Y-%m-%d'),
+        "time_start": game_datetime.dt.strftime('%H:%M:%S'),
+        "day_of_week": game_datetime.dt.strftime('%A'),
+        "outcome": mine['win'].map({True: "Win", False: "Loss"}),
+        "champion": mine['championName'],
+        "role": mine['teamPosition'],
+    }).reset_index(drop=True)
+
+
+async def main(args: argparse.Namespace):
     GAME_NAME = "Blearhunter"
     TAG_LINE = "8100"
     REGION = "europe"
     TOTAL_GAMES_TO_FETCH = 1000
 
+    # Check before fetching, so a missing engine doesn't throw away a long run's data
+    if not args.csv and not any(importlib.util.find_spec(engine) for engine in PARQUET_ENGINES):
+        print("Parquet output needs pyarrow (pip install -r requirements.txt), or pass --csv. Exiting.")
+        return
+
     print(f"Starting process to fetch the last {TOTAL_GAMES_TO_FETCH} games...")
-    
-    my_puuid = get_puuid(GAME_NAME, TAG_LINE, REGION)
-    if not my_puuid:
-        print("Could not retrieve PUUID. Exiting.")
-        exit()
-    
-    print(f"Successfully found PUUID: {my_puuid}")
-    
-    all_match_ids = []
-    start_index = 0
-    # Loop to fetch games in chunks of 100 until the desired total is reached
-    while len(all_match_ids) < TOTAL_GAMES_TO_FETCH:
-        print(f"Fetching games from index {start_index}...")
-        
-        # We fetch 100 games at a time, which is the max count allowed by the API
-        chunk_match_ids = get_match_ids(my_puuid, 100, start_index, REGION)
-        
-        # If the API returns an empty list, it means there's no more match history
-        if not chunk_match_ids:
-            print("No more matches found in history. Stopping.")
-            break
-        
-        all_match_ids.extend(chunk_match_ids)
-        start_index += 100 # Increment the start index for the next request
-        
-        # A small delay to be respectful to the API between calls for the match list
-        time.sleep(1)
-
-    print(f"Found {len(all_match_ids)} total match IDs. Fetching details for each...")
-    
-    all_games_data = []
-    # Loop through the master list of all fetched match IDs
-    for i, match_id in enumerate(all_match_ids):
-        # Provide progress feedback to the user
-        print(f"Processing match {i+1}/{len(all_match_ids)}...")
-        
-        details = get_match_details(match_id, my_puuid, REGION)
-        if details:
-            all_games_data.append(details)
-        
-        # --- CRITICAL: Respect API Rate Limits ---
-        # A 1.2-second sleep is a safe buffer to not exceed the 100 requests/2 mins limit.
-        time.sleep(1.2)
-
-    if not all_games_data:
+
+    # One client for the whole run so every request reuses the same connection
+    async with httpx.AsyncClient(headers=HEADERS, http2=True, timeout=15.0) as client:
+        my_puuid = await get_puuid(client, GAME_NAME, TAG_LINE, REGION)
+        if not my_puuid:
+            print("Could not retrieve PUUID. Exiting.")
+            return
+
+        print(f"Successfully found PUUID: {my_puuid}")
+
+        all_match_ids = []
+        start_index = 0
+        # Loop to fetch games in chunks of 100 until the desired total is reached
+        while len(all_match_ids) < TOTAL_GAMES_TO_FETCH:
+            print(f"Fetching games from index {start_index}...")
+
+            # We fetch 100 games at a time, which is the max count allowed by the API
+            chunk_match_ids = await get_match_ids(client, my_puuid, 100, start_index, REGION)
+
+            # If the API returns an empty list, it means there's no more match history
+            if not chunk_match_ids:
+                print("No more matches found in history. Stopping.")
+                break
+
+            all_match_ids.extend(chunk_match_ids)
+            start_index += 100 # Increment the start index for the next request
+
+        print(f"Found {len(all_match_ids)} total match IDs. Fetching details for each...")
+
+        raw_matches = await fetch_all(client, all_match_ids, REGION)
+
+    if not raw_matches:
         print("No match data could be processed.")
-        exit()
+        return
 
-    # Convert the list of dictionaries to a pandas DataFrame
-    df = pd.DataFrame(all_games_data)
+    # Extract the player's data from all matches at once
+    df = build_history_frame(raw_matches, my_puuid)
+    if df.empty:
+        print("No match data could be processed.")
+        return
     
-    # Save the DataFrame to a CSV file
-    output_filename = "lol_ranked_history.csv"
-    df.to_csv(output_filename, index=False)
+    if args.csv:
+        output_filename = "lol_ranked_history.csv"
+        df.to_csv(output_filename, index=False)
+    else:
+        # Parquet is smaller on disk and much faster to reload for analysis
+        output_filename = "lol_ranked_history.parquet"
+        df = df.astype({col: "category" for col in CATEGORY_COLUMNS})
+        df.to_parquet(output_filename, compression="zstd", index=False)
     
     print(f"\n✅ Success! Data for {len(df)} games has been saved to '{output_filename}'")
     print("\nFirst 5 rows of your new dataset:")
-    print(df.head())
\ No newline at end of file
+    print(df.head())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch ranked match history into a dataset.")
+    parser.add_argument("--csv", action="store_true", help="write a human-readable CSV instead of Parquet")
+    asyncio.run(main(parser.parse_args()))
@@ -1,37 +1,71 @@
 import asyncio
+import time
 from temporalio import activity
 
 import redis_service
 import riot_api_client
+import http_clients
 import config
 import key_service
 
+# Minimum spacing between heartbeats from looping activities; well under their heartbeat timeouts.
+HEARTBEAT_INTERVAL_SECONDS = 5.0
+# Most match IDs the Riot API returns per page.
+MATCH_IDS_PAGE_SIZE = 100
+
+def _as_player_id(player_id_or_cache_key: str) -> str:
+    """
+    The cache activities used to take the player's full cache key. Tasks scheduled
+    before they switched to player_id may still pass "cache:{player_id}".
+    """
+    return player_id_or_cache_key.removeprefix(key_service.CACHE_KEY_PREFIX)
+
 @activity.defn
 async def get_puuid_activity(game_name: str, tag_line: str, region: str) -> str:
     """Activity to fetch a player's PUUID from the Riot API."""
-    async with riot_api_client.httpx.AsyncClient() as client:
-        return await riot_api_client.get_puuid(client, game_name, tag_line, region)
+    client = http_clients.get_riot_client()
+    return await riot_api_client.get_puuid(client, game_name, tag_line, region)
 
 @activity.defn
 async def get_match_ids_activity(puuid: str, region: str) -> list[str]:
-    """Activity to fetch a list of match IDs for a given PUUID."""
-    all_match_ids = []
-    start_index = 0
-    async with riot_api_client.httpx.AsyncClient() as client:
-        while len(all_match_ids) < config.GAMES_TO_FETCH:
-            activity.heartbeat()
-            if activity.is_cancelled():
-                activity.log.info("Activity cancelled.")
-                raise asyncio.CancelledError("Activity was cancelled.")
-            count_to_fetch = min(100, config.GAMES_TO_FETCH - len(all_match_ids))
-            chunk = await riot_api_client.get_match_ids_async(
-                client, puuid, count_to_fetch, start_index, region
-            )
-            if not chunk: break
-            all_match_ids.extend(chunk)
-            start_index += len(chunk)
-            if len(chunk) < 100: break
-            await asyncio.sleep(config.API_REQUEST_DELAY_SECONDS)
+    """
+    Activity to fetch a list of match IDs for a given PUUID.
+    The first page is fetched alone; only if it is full are the remaining pages
+    requested concurrently, so short histories don't spend rate-limit budget on
+    pages that would come back empty.
+    """
+    client = http_clients.get_riot_client()
+    # Report liveness before the first page, which may wait for a rate-limit turn.
+    activity.heartbeat(0)
+    page_size = min(MATCH_IDS_PAGE_SIZE, config.GAMES_TO_FETCH)
+    all_match_ids = await riot_api_client.get_match_ids_async(client, puuid, page_size, 0, region) or []
+    if len(all_match_ids) < MATCH_IDS_PAGE_SIZE:
+        return all_match_ids
+
+    last_heartbeat = 0.0
+    # Pages finish out of order, so progress is a running count of IDs fetched.
+    fetched = len(all_match_ids)
+
+    async def fetch_page(start_index: int) -> list | None:
+        nonlocal last_heartbeat, fetched
+        count = min(MATCH_IDS_PAGE_SIZE, config.GAMES_TO_FETCH - start_index)
+        chunk = await riot_api_client.get_match_ids_async(client, puuid, count, start_index, region)
+        fetched += len(chunk or ())
+        now = time.monotonic()
+        if now - last_heartbeat > HEARTBEAT_INTERVAL_SECONDS:
+            activity.heartbeat(fetched)
+            last_heartbeat = now
+        return chunk
+
+    pages = await asyncio.gather(*(
+        fetch_page(start_index)
+        for start_index in range(MATCH_IDS_PAGE_SIZE, config.GAMES_TO_FETCH, MATCH_IDS_PAGE_SIZE)
+    ))
+    # Keep pages in order and stop at the end of the history.
+    for chunk in pages:
+        if not chunk: break
+        all_match_ids.extend(chunk)
+        if len(chunk) < MATCH_IDS_PAGE_SIZE: break
     return all_match_ids
 
 
@@ -39,21 +73,74 @@ async def get_match_ids_activity(puuid: str, region: str) -> list[str]:
 async def get_match_details_activity(match_id: str, puuid: str, region: str) -> dict | None:
     """Activity to fetch details for a single match."""
     try:
-        async with riot_api_client.httpx.AsyncClient(timeout=15.0) as client:
-            result = await riot_api_client.get_match_details_async(client, match_id, puuid, region)
-            await asyncio.sleep(config.API_REQUEST_DELAY_SECONDS)
-            return result
+        client = http_clients.get_riot_client()
+        return await riot_api_client.get_match_details_async(client, match_id, puuid, region)
     except Exception as e:
         activity.log.error(f"Failed to get details for match {match_id}: {e}", exc_info=True)
         return None
     
 @activity.defn
-async def save_results_to_cache_activity(cache_key: str, results: list):
-    """Saves the final results list to the specified cache key."""
+async def get_match_details_batch_activity(
+    match_ids: list[str],
+    puuid: str,
+    region: str,
+    progress_channel: str | None = None,
+    lock_key: str | None = None,
+) -> list[dict]:
+    """
+    Activity to fetch details for a batch of matches concurrently.
+    Pacing is left to the Riot rate limiter; the semaphore only bounds in-flight requests.
+    Each finished match (fetched or not) is published to progress_channel, if given.
+    While the batch runs it periodically renews lock_key, if given, because the
+    shared rate limit makes the lock time set up front only an estimate.
+    """
+    client = http_clients.get_riot_client()
+    redis_client = (
+        await redis_service.get_async_redis_client() if progress_channel or lock_key else None
+    )
+    semaphore = asyncio.Semaphore(config.MATCH_DETAILS_CONCURRENCY)
+
+    async def keep_lock_alive():
+        # Runs on its own timer, so a batch stalled on a long rate-limit wait still renews.
+        while True:
+            await asyncio.sleep(config.LOCK_RENEW_INTERVAL_SECONDS)
+            try:
+                await redis_service.renew_lock(redis_client, lock_key, config.LOCK_TIMEOUT_SECONDS)
+            except Exception as e:
+                activity.logger.warning(f"Failed to renew lock {lock_key}: {e}")
+
+    async def fetch_one(match_id: str) -> dict | None:
+        async with semaphore:
+            try:
+                return await riot_api_client.get_match_details_async(client, match_id, puuid, region)
+            finally:
+                activity.heartbeat()
+                if progress_channel:
+                    await redis_service.publish_progress(redis_client, progress_channel)
+
+    lock_renewal = asyncio.create_task(keep_lock_alive()) if lock_key else None
+    try:
+        results = await asyncio.gather(*(fetch_one(mid) for mid in match_ids), return_exceptions=True)
+    finally:
+        if lock_renewal:
+            lock_renewal.cancel()
+    for match_id, result in zip(match_ids, results):
+        if isinstance(result, Exception):
+            activity.logger.error(f"Failed to get details for match {match_id}: {result}")
+    return [result for result in results if isinstance(result, dict)]
+
+@activity.defn
+async def save_results_to_cache_activity(player_id: str, results: list):
+    """
+    Saves the final results list to the player's cache key, and each match
+    individually so later runs can look them up by id.
+    """
+    player_id = _as_player_id(player_id)
+    cache_key = key_service.get_cache_key(player_id)
     activity.logger.info(f"Saving {len(results)} matches to cache key '{cache_key}'")
     try:
-        redis_client = redis_service.get_redis_client()
-        redis_service.set_in_cache(redis_client, cache_key, results)
+        redis_client = await redis_service.get_async_redis_client()
+        await redis_service.save_player_results(redis_client, player_id, results)
         activity.logger.info("Successfully saved results to Redis.")
     except Exception as e:
         activity.logger.error(f"Failed to save results to Redis: {e}", exc_info=True)
@@ -61,35 +148,43 @@ async def save_results_to_cache_activity(cache_key: str, results: list):
 
 
 @activity.defn
-async def filter_cached_matches_activity(cache_key: str, candidate_match_ids: list[str]) -> dict:
+async def filter_cached_matches_activity(player_id: str, candidate_match_ids: list[str]) -> dict:
     """
     Returns a dict containing cached match objects for IDs present in cache and
     a list of missing match IDs that need to be fetched.
+    Since this is the point where the amount of work becomes known, it also
+    extends the player's job lock to cover fetching the missing matches.
 
     Response shape: {"existing": [match_obj,...], "missing_ids": [id,...]}
     """
+    player_id = _as_player_id(player_id)
     redis_client = None
     try:
-        redis_client = redis_service.get_redis_client()
-        cached_ids = redis_service.get_cached_match_ids(redis_client, cache_key) or set()
-
-        # Find which IDs are missing
-        missing = [mid for mid in candidate_match_ids if mid not in cached_ids]
-
-        # Load full cached objects for existing ids (if any)
-        existing_objs = []
-        if cached_ids:
-            cached_list = redis_service.get_from_cache(redis_client, cache_key) or []
-            # Build a map for quick lookup
+        redis_client = await redis_service.get_async_redis_client()
+        existing_objs, missing = await redis_service.get_cached_matches(
+            redis_client, player_id, candidate_match_ids
+        )
+
+        # Caches written before matches were stored individually only have the
+        # combined list; fall back to it so those players aren't refetched. A
+        # player who has the hash but none of these matches has nothing older to find.
+        if not existing_objs and not await redis_client.exists(
+            key_service.get_match_index_key(player_id)
+        ):
+            cache_key = key_service.get_cache_key(player_id)
+            cached_list = await redis_service.get_from_cache(redis_client, cache_key) or []
             id_map = {item.get("match_id"): item for item in cached_list if isinstance(item, dict) and item.get("match_id")}
-            for mid in candidate_match_ids:
-                if mid in id_map:
-                    existing_objs.append(id_map[mid])
+            existing_objs = [id_map[mid] for mid in candidate_match_ids if mid in id_map]
+            missing = [mid for mid in candidate_match_ids if mid not in id_map]
+
+        if missing:
+            lock_ttl = max(config.LOCK_TIMEOUT_SECONDS, len(missing) * config.LOCK_SECONDS_PER_MATCH)
+            await redis_client.expire(key_service.get_lock_key(player_id), lock_ttl)
 
         return {"existing": existing_objs, "missing_ids": missing}
 
     except Exception as e:
-        activity.log.error(f"Error filtering cached matches for key {cache_key}: {e}", exc_info=True)
+        activity.log.error(f"Error filtering cached matches for player {player_id}: {e}", exc_info=True)
         # Re-raise so Temporal retry policy can handle transient problems
         raise
 
@@ -102,11 +197,11 @@ async def extend_lock_activity(lock_key: str, extend_by_seconds: int) -> bool:
     """
     redis_client = None
     try:
-        redis_client = redis_service.get_redis_client()
+        redis_client = await redis_service.get_async_redis_client()
         # The EXPIRE command in Redis resets the timeout on a key.
         # It returns 1 if the timeout was set, and 0 if the key does not exist.
         # We return this boolean to the workflow, though it's not currently used.
-        was_extended = redis_client.expire(lock_key, extend_by_seconds)
+        was_extended = await redis_client.expire(lock_key, extend_by_seconds)
         if not was_extended:
             activity.logger.warning(f"Attempted to extend a lock that no longer exists: {lock_key}")
         return bool(was_extended)
@@ -117,28 +212,20 @@ async def extend_lock_activity(lock_key: str, extend_by_seconds: int) -> bool:
 
 
 @activity.defn
-async def release_and_cleanup_activity(lock_key: str, cooldown_key: str, cooldown_seconds: int):
+async def release_and_cleanup_activity(
+    lock_key: str, cooldown_key: str, cooldown_seconds: int, done_channel: str | None = None
+):
     """
-    Atomically releases the lock and sets the post-update cooldown.
+    Atomically releases the lock and sets the post-update cooldown, then
+    notifies requests waiting on done_channel that the update finished.
     This is called from the workflow's 'finally' block to ensure cleanup.
     """
     redis_client = None
     try:
-        redis_client = redis_service.get_redis_client()
-        
-        # Using a pipeline ensures that both commands are sent to Redis together,
-        # reducing the chance of a failure between the two operations.
-        pipe = redis_client.pipeline()
-        
-        # 1. Delete the in-progress lock.
-        pipe.delete(lock_key)
-        
-        # 2. Set the cooldown to prevent another immediate update.
-        pipe.setex(cooldown_key, cooldown_seconds, "1")
-        
-        # Execute both commands.
-        pipe.execute()
-        
+        redis_client = await redis_service.get_async_redis_client()
+        await redis_service.release_lock_and_set_cooldown(
+            redis_client, lock_key, cooldown_key, cooldown_seconds, done_channel
+        )
         activity.logger.info(f"Released lock '{lock_key}' and set cooldown '{cooldown_key}'.")
     except Exception as e:
         activity.logger.error(f"Failed to release lock and set cooldown for {lock_key}: {e}")
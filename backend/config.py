@@ -1,15 +1,30 @@
 import os
 from dotenv import load_dotenv
 
-# This will load the .env file only if the variables are not already set
-# (e.g., by docker-compose). It's safe to run everywhere.
-load_dotenv()
+# Only look for a .env file when the environment hasn't been provided
+# (e.g., by docker-compose), so containers skip the file search on startup.
+if "RIOT_API_KEY" not in os.environ:
+    load_dotenv()
 
 # --- RIOT API ---
 RIOT_API_KEY = os.getenv("RIOT_API_KEY")
 GAMES_TO_FETCH = 500
-API_REQUEST_DELAY_SECONDS = 1.25
-API_REQUEST_DELAY_MS = int(API_REQUEST_DELAY_SECONDS * 1000)
+# Global request budget shared through Redis by every process that calls Riot,
+# the API server's player lookups included. Kept slightly under Riot's 100
+# requests / 2 minutes as a margin for requests Riot counts that the budget
+# missed (e.g. ones in flight when a process restarted).
+RIOT_RATE_LIMIT_MAX_REQUESTS = 95
+RIOT_RATE_LIMIT_WINDOW_MS = 120000
+# Match details are fetched in batches; each batch activity keeps at most
+# MATCH_DETAILS_CONCURRENCY requests in flight over the shared client.
+MATCH_DETAILS_BATCH_SIZE = 50
+MATCH_DETAILS_CONCURRENCY = 20
+# Batches a single workflow keeps scheduled at once.
+MATCH_DETAILS_BATCHES_IN_FLIGHT = 2
+# Riot-facing activities one worker runs at once. The rate limiter sets the pace,
+# so this only bounds in-flight work (batches x MATCH_DETAILS_CONCURRENCY stays
+# within the HTTP client's connection pool).
+API_WORKER_MAX_CONCURRENT_ACTIVITIES = 4
 
 # --- REDIS & TEMPORAL ---
 # Provides a default of 'localhost' for local development
@@ -17,12 +32,46 @@ REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 TEMPORAL_HOST = os.getenv('TEMPORAL_HOST', 'localhost')
 REDIS_PORT = 6379
 REDIS_DB = 0
+# Path to Redis' Unix socket when it runs on the same host; skips the TCP stack.
+# Takes precedence over REDIS_HOST/REDIS_PORT when set.
+REDIS_UNIX_SOCKET = os.getenv("REDIS_UNIX_SOCKET")
+# Per-process pool size; callers wait up to REDIS_POOL_TIMEOUT_SECONDS for a free
+# connection instead of failing with "Too many connections".
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT_SECONDS = 20
 
 # --- CACHING & LOCKING ---
 CACHE_EXPIRATION_SECONDS = 15552000  # 180 days
+# Cached history younger than this is served as-is; older history is still
+# served (until it expires) but triggers a background refresh.
+CACHE_FRESH_SECONDS = 21600  # 6 hours
+# zstd level for cached history blobs; JSON compresses well even at low levels
+CACHE_ZSTD_LEVEL = 3
 COOLDOWN_SECONDS = 60  # 1 hour
 LOCK_TIMEOUT_SECONDS = 300  # 5 minutes
+# Lock time budgeted per match still to fetch, set once the missing matches are
+# known. The Riot budget is shared by every running job, so this is only an
+# estimate; batch activities also renew the lock while they run.
+LOCK_SECONDS_PER_MATCH = 2
+# How often a running batch pushes the lock's TTL back up to LOCK_TIMEOUT_SECONDS
+LOCK_RENEW_INTERVAL_SECONDS = 60
+# How long POST /update?wait=true waits for an already-running update to finish
+UPDATE_WAIT_TIMEOUT_SECONDS = 30
+
+# --- STATUS STREAM ---
+# Progress is pushed over Redis Pub/Sub; Temporal is only re-queried when nothing
+# has been pushed for this long (or once the job announces it is done).
+STREAM_STATUS_FALLBACK_SECONDS = 15
+# Short polls (e.g. while a finished job closes) start here and double up to the cap.
+STREAM_STATUS_MIN_POLL_SECONDS = 0.25
+STREAM_STATUS_MAX_POLL_SECONDS = 4
+
+# --- HEALTH CHECK ---
+# Upper bound for /health's dependency checks, which run concurrently.
+HEALTH_CHECK_TIMEOUT_SECONDS = 2.0
 
 # --- TEMPORAL TASK QUEUE ---
 TEMPORAL_TASK_QUEUE = "match-history-task-queue"
-INTERNAL_TASK_QUEUE = "internal-tasks"
\ No newline at end of file
+INTERNAL_TASK_QUEUE = "internal-tasks"
+# Payloads at least this large are zstd-compressed before entering workflow history.
+TEMPORAL_PAYLOAD_COMPRESSION_MIN_BYTES = 1024
@@ -0,0 +1,34 @@
+import httpx
+import config
+
+# A single, process-wide client so that repeated requests to the same Riot
+# regional host reuse pooled keep-alive connections instead of paying a new
+# TCP+TLS handshake per call.
+_riot_client: httpx.AsyncClient | None = None
+
+
+def get_riot_client() -> httpx.AsyncClient:
+    """
+    Returns the shared Riot API client, creating it lazily on first use.
+    Safe to call from the worker's activities and the API's request handlers.
+    """
+    global _riot_client
+    if _riot_client is None or _riot_client.is_closed:
+        _riot_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(15.0, connect=5.0),
+            # Keep every pooled connection alive; with several batches running at once,
+            # connections beyond the keep-alive cap would be closed and re-handshaken.
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=100),
+            # Concurrent requests to the same regional host multiplex over one connection.
+            http2=True,
+            headers={"X-Riot-Token": config.RIOT_API_KEY},
+        )
+    return _riot_client
+
+
+async def close_riot_client():
+    """Closes the shared Riot API client. Called once on worker and API shutdown."""
+    global _riot_client
+    if _riot_client is not None:
+        await _riot_client.aclose()
+        _riot_client = None
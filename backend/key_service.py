@@ -1,26 +1,63 @@
+from functools import lru_cache
+
 # --- Static Keys ---
-# This key is global and doesn't depend on a player.
-RATE_LIMIT_LOCK_KEY = "riot_api_rate_limit_lock"
+# This key is global and doesn't depend on a player: the sorted set of recent
+# Riot API request timestamps shared by all workers.
+RIOT_RATE_LIMIT_KEY = "riot_api_rate_limit_window"
+
+
+def get_worker_heartbeat_key(task_queue: str) -> str:
+    """Returns the Redis key a worker refreshes to signal it is alive."""
+    return f"worker:heartbeat:{task_queue}"
 
 
 # --- Dynamic Key Generators ---
 # These functions ensure a consistent format for all player-specific keys.
 
+# The same players are polled over and over, so the hot per-request keys are
+# memoized: repeat lookups return the same string instead of rebuilding it.
+_KEY_CACHE_SIZE = 8192
+
+@lru_cache(maxsize=_KEY_CACHE_SIZE)
 def get_player_id(game_name: str, tag_line: str, region: str) -> str:
     """Creates the standardized player identifier string."""
     return f"{game_name.lower()}#{tag_line.lower()}@{region.lower()}"
 
+@lru_cache(maxsize=_KEY_CACHE_SIZE)
 def get_lock_key(player_id: str) -> str:
     """Returns the Redis key for a player's job lock."""
     return f"lock:{player_id}"
 
+@lru_cache(maxsize=_KEY_CACHE_SIZE)
 def get_cooldown_key(player_id: str) -> str:
     """Returns the Redis key for a player's update cooldown."""
     return f"cooldown:{player_id}"
 
+CACHE_KEY_PREFIX = "cache:"
+
+@lru_cache(maxsize=_KEY_CACHE_SIZE)
 def get_cache_key(player_id: str) -> str:
     """Returns the Redis key for a player's final cached data."""
-    return f"cache:{player_id}"
+    return f"{CACHE_KEY_PREFIX}{player_id}"
+
+def get_cache_meta_key(player_id: str) -> str:
+    """Returns the Redis key for the hash holding the cache's generated_at/stale_at timestamps."""
+    return f"cache:{player_id}:meta"
+
+def get_match_index_key(player_id: str) -> str:
+    """Returns the Redis key for the hash of a player's cached matches, keyed by match ID."""
+    return f"matches:{player_id}"
+
+def get_done_channel(player_id: str) -> str:
+    """Returns the Pub/Sub channel announcing that a player's update job finished."""
+    return f"done:{player_id}"
+
+def get_progress_channel(player_id: str) -> str:
+    """Returns the Pub/Sub channel that carries a running job's per-match progress."""
+    return f"progress:{player_id}"
+
+# Patterns matching every player's done and progress channels.
+JOB_CHANNEL_PATTERNS = ("done:*", "progress:*")
 
 def get_error_key(player_id: str) -> str:
     """Returns the Redis key for storing a job's error message."""
@@ -9,21 +9,27 @@ from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
 from temporalio.client import Client, WorkflowExecutionStatus
 from temporalio.exceptions import WorkflowAlreadyStartedError
+from temporalio.service import RPCError, RPCStatusCode
 import redis
-import httpx
-from schemas import ProgressState, CompletedState, FailedState, NoMatchesState
+import redis.asyncio
+import orjson
+from pydantic import TypeAdapter
+from schemas import ProgressState, CompletedState, FailedState, NoMatchesState, WorkflowStatus
 from fastapi import status, Response
 from temporalio.api.enums.v1 import TaskQueueType
 import time
+import random
 import config
 import redis_service
 import key_service
+import http_clients
+import temporal_codec
 from temporal_workflows import FetchMatchHistoryWorkflow
 import riot_api_client
 
 # --- APP INITIALIZATION ---
 temporal_client: Client | None = None
-redis_client: redis.Redis | None = None
+redis_client: redis.asyncio.Redis | None = None
 logging.basicConfig(level=logging.INFO)
 
 @asynccontextmanager
@@ -37,7 +43,9 @@ async def lifespan(app: FastAPI):
     retry_delay = 3  # seconds
     for attempt in range(max_retries):
         try:
-            temporal_client = await Client.connect(f"{config.TEMPORAL_HOST}:7233")
+            temporal_client = await Client.connect(
+                f"{config.TEMPORAL_HOST}:7233", data_converter=temporal_codec.DATA_CONVERTER
+            )
             logging.info("Successfully connected to Temporal server.")
             break  # Exit loop on success
         except Exception as e:
@@ -54,8 +62,10 @@ async def lifespan(app: FastAPI):
 
     try:
         # Connect to Redis (can also have a retry loop if needed, but it's usually faster)
-        redis_client = redis_service.get_redis_client()
+        redis_client = await redis_service.get_async_redis_client(check_connection=True)
         logging.info("Successfully connected to Redis server.")
+        # One shared Pub/Sub connection serves every status stream and waiting request.
+        redis_service.channel_hub.start(redis_client)
     except Exception as e:
         logging.error(f"FATAL: Could not connect to Redis: {e}")
         sys.exit(1)
@@ -63,13 +73,33 @@ async def lifespan(app: FastAPI):
     yield # Application runs here
 
     logging.info("FastAPI shutting down.")
+    await redis_service.channel_hub.stop()
+    await redis_service.close_async_redis_client()
+    await http_clients.close_riot_client()
     if temporal_client:
         await temporal_client.disconnect()
 
 app = FastAPI(lifespan=lifespan)
 
+# Built once: serializes any status model straight to JSON bytes for SSE frames.
+STATUS_ADAPTER = TypeAdapter(WorkflowStatus)
+
+def sse_event(status_json: bytes) -> bytes:
+    """Wraps serialized status JSON in an SSE data frame."""
+    return b"data: " + status_json + b"\n\n"
+
+# Payloads that never change are encoded once at import time.
+COMPLETED_JSON = STATUS_ADAPTER.dump_json(CompletedState(status="completed"))
+HEARTBEAT_FRAME = b": heartbeat\n\n"
+
+def status_json(status_model: WorkflowStatus) -> bytes:
+    """Serializes a status model, reusing the precomputed bytes for constant states."""
+    if isinstance(status_model, CompletedState):
+        return COMPLETED_JSON
+    return STATUS_ADAPTER.dump_json(status_model)
+
 # --- DEPENDENCY ---
-def get_redis() -> redis.Redis:
+def get_redis() -> redis.asyncio.Redis:
     """Dependency to provide the Redis client to routes."""
     if redis_client is None:
         raise HTTPException(status_code=503, detail="Redis connection not available")
@@ -88,7 +118,7 @@ app.add_middleware(
 
 # --- ENDPOINTS ---
 @app.get("/health", status_code=status.HTTP_200_OK)
-async def health_check(r: redis.Redis = Depends(get_redis)):
+async def health_check(r: redis.asyncio.Redis = Depends(get_redis)):
     """
     Performs a comprehensive health check on all critical dependencies.
     Returns 200 OK if all healthy, 503 Service Unavailable otherwise.
@@ -97,19 +127,31 @@ async def health_check(r: redis.Redis = Depends(get_redis)):
         raise HTTPException(status_code=503, detail="Temporal client not initialized.")
 
     try:
-        # 1. Check Redis connection
-        if not r.ping():
-            raise HTTPException(status_code=503, detail="Redis connection failed (ping).")
+        # 1-3. Redis (ping plus the worker heartbeat read, in one pipeline), the Temporal
+        # gRPC connection and the task queue's pollers are checked concurrently.
+        task_queue_name = config.TEMPORAL_TASK_QUEUE
+        heartbeat_key = key_service.get_worker_heartbeat_key(task_queue_name)
+        pipe = r.pipeline(transaction=False)
+        pipe.ping()
+        pipe.get(heartbeat_key)
+        try:
+            (pong, heartbeat_timestamp), _, tq_desc = await asyncio.wait_for(
+                asyncio.gather(
+                    pipe.execute(),
+                    temporal_client.check_health(),
+                    temporal_client.workflow_service.describe_task_queue(
+                        namespace="default",
+                        task_queue={"name": task_queue_name, "kind": TaskQueueType.WORKFLOW},
+                    ),
+                ),
+                timeout=config.HEALTH_CHECK_TIMEOUT_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Dependencies did not respond in time.")
 
-        # 2. Check Temporal gRPC connection
-        await temporal_client.check_health()
+        if not pong:
+            raise HTTPException(status_code=503, detail="Redis connection failed (ping).")
 
-        # 3. Check for active Temporal workers polling the task queue
-        task_queue_name = config.TEMPORAL_TASK_QUEUE
-        tq_desc = await temporal_client.workflow_service.describe_task_queue(
-            namespace="default",
-            task_queue={"name": task_queue_name, "kind": TaskQueueType.WORKFLOW},
-        )
         if not tq_desc.pollers:
             raise HTTPException(
                 status_code=503,
@@ -117,10 +159,8 @@ async def health_check(r: redis.Redis = Depends(get_redis)):
             )
         
         # 4. Check for a recent Temporal worker heartbeat in Redis
-        heartbeat_key = f"worker:heartbeat:{task_queue_name}"
         heartbeat_ttl_seconds = 60
 
-        heartbeat_timestamp = r.get(heartbeat_key)
         if not heartbeat_timestamp:
             raise HTTPException(
                 status_code=503,
@@ -145,29 +185,48 @@ async def health_check(r: redis.Redis = Depends(get_redis)):
 
 
 @app.get("/history/{game_name}/{tag_line}/{region}")
-async def get_history(game_name: str, tag_line: str, region: str, r: redis.Redis = Depends(get_redis)):
+async def get_history(game_name: str, tag_line: str, region: str, r: redis.asyncio.Redis = Depends(get_redis)):
     """
     Checks for cached match history. If not found, validates player existence.
-    - Returns 200 OK with data if cached.
+    - Returns 200 OK with data if cached. Stale data is still returned (status "stale"),
+      and a background refresh is started if none is running and no cooldown is active.
     - Returns 204 No Content if the player is valid but has no cache.
     - Returns 404 Not Found if the player does not exist.
     """
     player_id = key_service.get_player_id(game_name, tag_line, region)
-    cache_key = key_service.get_cache_key(player_id)
-    lock_key = key_service.get_lock_key(player_id)
-    cooldown_key = key_service.get_cooldown_key(player_id)
-    active_cooldown = redis_service.get_cooldown_ttl(r, cooldown_key)
-
-    if cached_data := redis_service.get_from_cache(r, cache_key):
-        # Also indicate if an update is currently in progress for this player so clients
-        # can automatically attach to the SSE stream and show live progress.
-        in_progress = bool(r.exists(lock_key))
-        return {"status": "cached", "data": cached_data, "in_progress": in_progress, "cooldown": active_cooldown,}
+    # Cache, freshness and job state in one round-trip. The in-progress flag lets
+    # clients automatically attach to the SSE stream and show live progress.
+    state = await redis_service.snapshot_player_state(r, player_id)
+    active_cooldown, in_progress = state.cooldown_ttl, state.in_progress
+
+    if cached_json := state.cached_json:
+        cache_status = "cached"
+        # Caches written before freshness was tracked have no stale_at and count as stale.
+        if state.stale_at is None or time.time() >= state.stale_at:
+            cache_status = "stale"
+            if not in_progress and active_cooldown <= 0:
+                try:
+                    job_status, _ = await start_update_workflow(r, player_id, game_name, tag_line, region)
+                    in_progress = job_status != "cooldown"
+                except Exception as e:
+                    logging.warning(f"Could not start background refresh for {player_id}: {e}")
+        # The cached JSON is spliced into the envelope as-is instead of being
+        # parsed and re-serialized by FastAPI on every hit.
+        return Response(
+            content=orjson.dumps({
+                "status": cache_status,
+                "data": orjson.Fragment(cached_json),
+                "in_progress": in_progress,
+                "cooldown": active_cooldown,
+            }),
+            media_type="application/json",
+        )
 
     try:
-        async with httpx.AsyncClient() as client:
-            await riot_api_client.validate_player_in_region_async(client, game_name, tag_line, region)
-        
+        # Reuse the pooled Riot client so lookups don't pay a new TLS handshake each time.
+        client = http_clients.get_riot_client()
+        await riot_api_client.validate_player_in_region_async(client, game_name, tag_line, region)
+
         return Response(status_code=204)
 
     except riot_api_client.PlayerNotFound as e:
@@ -175,30 +234,27 @@ async def get_history(game_name: str, tag_line: str, region: str, r: redis.Redis
         raise HTTPException(status_code=404, detail=str(e))
 
 
-@app.post("/update/{game_name}/{tag_line}/{region}")
-async def trigger_update_job(game_name: str, tag_line: str, region: str, r: redis.Redis = Depends(get_redis)):
-    player_id = key_service.get_player_id(game_name, tag_line, region)
-    cooldown_key = key_service.get_cooldown_key(player_id)
+async def start_update_workflow(
+    r: redis.asyncio.Redis, player_id: str, game_name: str, tag_line: str, region: str
+) -> tuple[str, int]:
+    """
+    Checks the player's cooldown, acquires the in-progress lock and starts the update workflow.
+    Returns (status, cooldown_ttl) where status is "started", "in_progress" if another
+    update is already running, or "cooldown" if the player was updated too recently.
+    If the workflow fails to start, the lock is released and the error re-raised.
+    """
     lock_key = key_service.get_lock_key(player_id)
+    cooldown_key = key_service.get_cooldown_key(player_id)
 
-    # If a cooldown is active and no update is currently running, refuse.
-    # But if there's an in-progress lock, allow attaching to that update (don't return 429).
-    if (ttl := redis_service.get_cooldown_ttl(r, cooldown_key)) > 0 and not r.exists(lock_key):
-        # Return a structured response so clients can reliably parse cooldown and in-progress state.
-        # We'll use HTTPException with a JSON-able detail.
-        raise HTTPException(status_code=429, detail={
-            "message": f"Please try again in {ttl} seconds.",
-            "cooldown_seconds": ttl,
-            "in_progress": False,
-        })
-
-    # Try to acquire an in-progress lock before starting the workflow. This prevents
+    # Check the cooldown and take the in-progress lock in one atomic step. This prevents
     # multiple concurrent starts for the same player. The worker will release the lock
     # and set the cooldown when it finishes.
-    acquired = redis_service.acquire_lock(r, lock_key, lock_timeout_seconds=config.LOCK_TIMEOUT_SECONDS)
-    if not acquired:
-        # Another update is already in progress. Let the caller know so they can attach via SSE.
-        return {"status": "in_progress"}
+    lock_state, ttl = await redis_service.acquire_update_lock(
+        r, cooldown_key, lock_key, lock_timeout_seconds=config.LOCK_TIMEOUT_SECONDS
+    )
+    if lock_state != "acquired":
+        # Either cooling down, or another update is running and the caller can attach via SSE.
+        return lock_state, ttl
 
     # We acquired the lock; now try to start the workflow. If starting fails, release the lock.
     try:
@@ -208,84 +264,183 @@ async def trigger_update_job(game_name: str, tag_line: str, region: str, r: redi
             id=player_id,
             task_queue=config.TEMPORAL_TASK_QUEUE
         )
-        return {"status": "started"}
+        return "started", 0
     except WorkflowAlreadyStartedError:
         # The workflow was already started by another concurrent request.
-        return {"status": "in_progress"}
-    except Exception as e:
+        return "in_progress", 0
+    except Exception:
         # If workflow fails to start, release the lock so subsequent attempts can proceed.
         try:
-            redis_service.release_lock(r, lock_key)
+            await redis_service.release_lock(r, lock_key)
         except Exception:
             pass
+        raise
+
+
+@app.post("/update/{game_name}/{tag_line}/{region}")
+async def trigger_update_job(
+    game_name: str, tag_line: str, region: str, wait: bool = False, r: redis.asyncio.Redis = Depends(get_redis)
+):
+    """
+    Starts an update for the player, or reports that one is already running.
+    With ?wait=true, a request that finds an update in progress waits for it to
+    finish (up to UPDATE_WAIT_TIMEOUT_SECONDS) and returns the fresh history.
+    """
+    player_id = key_service.get_player_id(game_name, tag_line, region)
+    lock_key = key_service.get_lock_key(player_id)
+
+    try:
+        job_status, ttl = await start_update_workflow(r, player_id, game_name, tag_line, region)
+    except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    # If a cooldown is active and no update is currently running, refuse.
+    # An in-progress update is reported as such so clients can attach to it (no 429).
+    if job_status == "cooldown":
+        # Return a structured response so clients can reliably parse cooldown and in-progress state.
+        # We'll use HTTPException with a JSON-able detail.
+        raise HTTPException(status_code=429, detail={
+            "message": f"Please try again in {ttl} seconds.",
+            "cooldown_seconds": ttl,
+            "in_progress": False,
+        })
+
+    if job_status == "in_progress" and wait:
+        # Coalesce with the running update instead of making the caller poll for it.
+        finished = await redis_service.wait_for_job_completion(
+            r, key_service.get_done_channel(player_id), lock_key, config.UPDATE_WAIT_TIMEOUT_SECONDS
+        )
+        if finished and (cached_json := await redis_service.get_from_cache_raw(r, key_service.get_cache_key(player_id))):
+            return Response(
+                content=orjson.dumps({"status": "completed", "data": orjson.Fragment(cached_json)}),
+                media_type="application/json",
+            )
+
+    return {"status": job_status}
+
+async def read_workflow_status(handle, player_id: str):
+    """
+    Describes/queries the workflow and maps it to a status model.
+    Returns (status_model or None on transient errors, finished).
+    """
+    try:
+        # This block is protected from transient Temporal errors.
+        desc = await handle.describe()
+
+        if desc.status == WorkflowExecutionStatus.RUNNING:
+            query_result = await handle.query(FetchMatchHistoryWorkflow.get_status)
+            if query_result.get("status") == "progress":
+                return ProgressState(
+                    status="progress",
+                    processed=query_result.get("processed", 0),
+                    total=query_result.get("total", 0)
+                ), False
+            return None, False
+        elif desc.status == WorkflowExecutionStatus.COMPLETED:
+            return CompletedState(status="completed"), True
+        else: # FAILED, TIMED_OUT, CANCELED
+            return FailedState(status="failed",error=f"Workflow ended with status: {desc.status.name}"), True
+
+    except Exception as e:
+        logging.warning(f"Error during stream for {player_id}: {e}. Retrying...")
+        # Don't produce a status model; the stream will try again.
+        return None, False
+
+
+def jittered(seconds: float) -> float:
+    """Spreads a wait by up to 20% so streams opened together don't poll in lockstep."""
+    return seconds * (1 + random.random() * 0.2)
+
+
+def next_backoff(seconds: float) -> float:
+    """Doubles a polling delay, capped at STREAM_STATUS_MAX_POLL_SECONDS."""
+    return min(seconds * 2, config.STREAM_STATUS_MAX_POLL_SECONDS)
+
+
 @app.get("/stream-status/{game_name}/{tag_line}/{region}")
-async def stream_status(game_name: str, tag_line: str, region: str, r: redis.Redis = Depends(get_redis)):
+async def stream_status(game_name: str, tag_line: str, region: str, r: redis.asyncio.Redis = Depends(get_redis)):
     player_id = key_service.get_player_id(game_name, tag_line, region)
 
     async def event_generator():
-        # First, patiently wait for the workflow handle to exist.
-        handle = None
-        for _ in range(10): # Try for 10 seconds
+        # get_workflow_handle() only builds a local object; describe() tells us whether
+        # the workflow exists. Right after /update took the lock it may still be starting.
+        handle = temporal_client.get_workflow_handle(player_id)
+        lock_key = key_service.get_lock_key(player_id)
+        error_msg = None
+        delay = config.STREAM_STATUS_MIN_POLL_SECONDS
+        deadline = time.monotonic() + 10 # Give it up to 10 seconds to appear
+        while True:
             try:
-                handle = temporal_client.get_workflow_handle(player_id)
+                await handle.describe()
                 break
-            except Exception:
-                await asyncio.sleep(1)
-        
-        # If it never appeared, the update failed to start.
-        if not handle:
-            # Check if the lock that was acquired to start the job still exists.
-            lock_key = key_service.get_lock_key(player_id)
-            if r.exists(lock_key):
-                # The lock exists, but the handle doesn't. This implies a serious Temporal issue.
-                error_msg = "Update process is stuck and may have failed to start. Please try again later."
-            else:
+            except RPCError as e:
+                if e.status != RPCStatusCode.NOT_FOUND:
+                    # Transient Temporal error; the status loop below keeps retrying.
+                    break
+            if not await r.exists(lock_key):
                 # The lock is gone, meaning the workflow startup failed and cleanup happened.
                 error_msg = "Update process failed during initialization."
-            
-            model = FailedState(error=error_msg)
-            yield f"data: {model.model_dump_json()}\n\n"
+                break
+            if time.monotonic() >= deadline:
+                # The lock exists, but the workflow doesn't. This implies a serious Temporal issue.
+                error_msg = "Update process is stuck and may have failed to start. Please try again later."
+                break
+            await asyncio.sleep(jittered(delay))
+            delay = next_backoff(delay)
+
+        if error_msg:
+            model = FailedState(status="failed", error=error_msg)
+            yield sse_event(STATUS_ADAPTER.dump_json(model))
             return
 
+        # Progress is pushed by the worker over Redis Pub/Sub; subscribe before the
+        # first status read so nothing published in between is missed.
+        progress_channel = key_service.get_progress_channel(player_id)
+        done_channel = key_service.get_done_channel(player_id)
+        # Messages carry the channel name as bytes.
+        progress_channel_name, done_channel_name = progress_channel.encode(), done_channel.encode()
+
         # Now, stream status from the handle we found.
         try:
-            while True:
-                status_model = None
-                try:
-                    # This block is now protected from transient Temporal errors.
-                    desc = await handle.describe()
-
-                    if desc.status == WorkflowExecutionStatus.RUNNING:
-                        query_result = await handle.query(FetchMatchHistoryWorkflow.get_status)
-                        if query_result.get("status") == "progress":
-                            status_model = ProgressState(
-                                status="progress",
-                                processed=query_result.get("processed", 0),
-                                total=query_result.get("total", 0)
-                            )
-                    elif desc.status == WorkflowExecutionStatus.COMPLETED:
-                        status_model = CompletedState(status="completed")
-                    else: # FAILED, TIMED_OUT, CANCELED
-                        status_model = FailedState(status="failed",error=f"Workflow ended with status: {desc.status.name}")
-
-                except Exception as e:
-                    logging.warning(f"Error during stream for {player_id}: {e}. Retrying...")
-                    # Don't set a status_model, just let the loop sleep and try again.
-
-                if status_model:
-                    yield f"data: {status_model.model_dump_json()}\n\n"
-                # If no model was produced this iteration, emit a heartbeat comment
-                # so proxies stay aware of an active stream and don't close it.
-                else:
-                    yield ": heartbeat\n\n"
-
-                # If the workflow reached a terminal state, stop streaming.
-                if 'desc' in locals() and desc.status not in [WorkflowExecutionStatus.RUNNING]:
-                    break
-                
-                await asyncio.sleep(1)
+            async with redis_service.channel_hub.subscribe(progress_channel, done_channel) as subscription:
+                status_model, finished = await read_workflow_status(handle, player_id)
+                wait_seconds = config.STREAM_STATUS_FALLBACK_SECONDS
+                last_payload = None
+                while True:
+                    # Serialize once and only send the event when it differs from the last one.
+                    payload = status_json(status_model) if status_model else None
+                    if payload and payload != last_payload:
+                        yield sse_event(payload)
+                        last_payload = payload
+                    # If nothing new was produced this iteration, emit a heartbeat comment
+                    # so proxies stay aware of an active stream and don't close it.
+                    else:
+                        yield HEARTBEAT_FRAME
+
+                    # If the workflow reached a terminal state, stop streaming.
+                    if finished:
+                        break
+
+                    message = await subscription.get_message(timeout=jittered(wait_seconds))
+                    if message and message["channel"] == progress_channel_name and isinstance(status_model, ProgressState):
+                        # Apply the pushed delta locally; Temporal is re-queried on the fallback path.
+                        status_model = status_model.model_copy(update={
+                            "processed": min(status_model.processed + int(message["data"]), status_model.total),
+                        })
+                        continue
+
+                    if message and message["channel"] == done_channel_name:
+                        # The job released its lock; the workflow closes momentarily, so poll
+                        # with a short delay that backs off until it does.
+                        wait_seconds = config.STREAM_STATUS_MIN_POLL_SECONDS
+                    elif wait_seconds < config.STREAM_STATUS_FALLBACK_SECONDS:
+                        wait_seconds = next_backoff(wait_seconds)
+                    # Nothing pushed for a while (or the job just finished): ask Temporal directly.
+                    previous = status_model
+                    status_model, finished = await read_workflow_status(handle, player_id)
+                    if isinstance(previous, ProgressState) and isinstance(status_model, ProgressState):
+                        # Temporal counts whole batches, so never step back behind pushed progress.
+                        status_model.processed = max(status_model.processed, previous.processed)
 
         except asyncio.CancelledError:
             logging.info(f"Client disconnected for stream {player_id}.")
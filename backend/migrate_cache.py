@@ -0,0 +1,30 @@
+"""
+One-shot migration of cached match histories to the compressed blob format.
+
+Older deployments stored each player's history as a sorted set of JSON members
+(or a plain JSON string). Reads now issue a single GET and expect a compressed
+blob, so run this once against Redis before rolling out the new API/worker:
+
+    python migrate_cache.py
+"""
+import redis_service
+
+# Player history keys are cache:{player_id}; cache:{player_id}:meta holds timestamps.
+CACHE_KEY_PATTERN = "cache:*"
+META_KEY_SUFFIX = b":meta"
+
+
+def main():
+    redis_client = redis_service.get_redis_client(check_connection=True)
+    scanned = migrated = 0
+    for key in redis_client.scan_iter(match=CACHE_KEY_PATTERN, count=1000):
+        if key.endswith(META_KEY_SUFFIX):
+            continue
+        scanned += 1
+        if redis_service.migrate_legacy_cache_entry(redis_client, key):
+            migrated += 1
+    print(f"Scanned {scanned} cache keys, migrated {migrated} legacy entries.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,142 +1,487 @@
+import asyncio
 import redis
-import json
+import redis.asyncio
+import orjson
+import zstandard
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 import config
+import key_service
 
-def get_redis_client():
+# Sliding-window log for the global Riot API budget: a sorted set of request
+# timestamps (server clock) shared by every worker. Unlike a fixed window it can't
+# let a full budget through on each side of a window boundary, and a refused caller
+# is told exactly when the oldest request ages out instead of all waking at once.
+_RIOT_TOKEN_LUA = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local window = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms - window)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], now_ms, ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return 0
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return math.max(tonumber(oldest[2]) + window - now_ms, 1)
+"""
+
+# Releases a job lock and starts the post-update cooldown in a single atomic step,
+# then announces completion to anyone waiting on the (optional) done channel.
+_RELEASE_AND_COOLDOWN_LUA = """
+redis.call('DEL', KEYS[1])
+redis.call('SETEX', KEYS[2], ARGV[1], '1')
+if KEYS[3] then
+    redis.call('PUBLISH', KEYS[3], 'done')
+end
+return 1
+"""
+
+# Checks the cooldown and takes the job lock in one step, so a cooldown set
+# between the two checks can't be missed. An already-running job wins over the
+# cooldown so callers can attach to it.
+_ACQUIRE_UPDATE_LOCK_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return {'in_progress', 0}
+end
+local ttl = redis.call('TTL', KEYS[1])
+if ttl > 0 then
+    return {'cooldown', ttl}
+end
+if redis.call('SET', KEYS[2], '1', 'NX', 'EX', ARGV[1]) then
+    return {'acquired', 0}
+end
+return {'in_progress', 0}
+"""
+
+# Raises a lock's TTL to ARGV[1] seconds but never shortens it, and leaves a
+# lock that is already gone (or has no expiry) alone. Unlike EXPIRE ... GT this
+# works on any Redis version.
+_RENEW_LOCK_LUA = """
+local ttl = redis.call('TTL', KEYS[1])
+if ttl >= 0 and ttl < tonumber(ARGV[1]) then
+    return redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+_registered_scripts = {}
+
+def _get_script(redis_client, lua: str):
+    """Registers a Lua script once; redis-py then calls it via EVALSHA with a NOSCRIPT fallback."""
+    # Sync and asyncio clients need their own Script objects.
+    script_key = (lua, isinstance(redis_client, redis.asyncio.Redis))
+    if script_key not in _registered_scripts:
+        _registered_scripts[script_key] = redis_client.register_script(lua)
+    return _registered_scripts[script_key]
+
+def _connection_kwargs(connection_module) -> dict:
+    """Where the pools connect: the Unix socket when configured, otherwise TCP."""
+    if config.REDIS_UNIX_SOCKET:
+        return {
+            "connection_class": connection_module.UnixDomainSocketConnection,
+            "path": config.REDIS_UNIX_SOCKET,
+        }
+    return {"host": config.REDIS_HOST, "port": config.REDIS_PORT}
+
+# A single pool per process, shared by everything that calls Redis synchronously
+# (maintenance scripts such as migrate_cache.py) instead of opening a new
+# connection per call. The pools are
+# bounded and blocking, so a burst waits for a free connection rather than
+# erroring out or opening more sockets. Replies are parsed by hiredis (installed
+# via the redis[hiredis] extra); redis-py picks it up for both clients.
+_POOL = redis.BlockingConnectionPool(
+    **_connection_kwargs(redis),
+    db=config.REDIS_DB,
+    max_connections=config.REDIS_MAX_CONNECTIONS,
+    timeout=config.REDIS_POOL_TIMEOUT_SECONDS,
+    # Cache blobs are zstd-compressed bytes; text values are decoded where read.
+    decode_responses=False,
+)
+_CLIENT = redis.Redis(connection_pool=_POOL)
+
+def get_redis_client(check_connection: bool = False):
     """
-    Factory function to create and connect to Redis on-demand.
-    This is safe to call from anywhere, including Temporal Activities.
+    Returns the process-wide Redis client backed by a shared connection pool.
+    For code without an event loop; async code should use get_async_redis_client.
+    Pass check_connection=True at startup to fail fast if Redis is unreachable.
     """
-    try:
-        client = redis.Redis(
-            host=config.REDIS_HOST,
-            port=config.REDIS_PORT,
-            db=config.REDIS_DB,
-            decode_responses=True,
-        )
-        client.ping()
-        return client
-    except redis.exceptions.ConnectionError as e:
-        print(f"FATAL: Could not connect to Redis. {e}")
-        # Re-raise the exception to make the calling function aware of the failure.
-        raise
+    if check_connection:
+        try:
+            _CLIENT.ping()
+        except redis.exceptions.ConnectionError as e:
+            print(f"FATAL: Could not connect to Redis. {e}")
+            # Re-raise the exception to make the calling function aware of the failure.
+            raise
+    return _CLIENT
+
+# Async counterpart used by the API handlers, the Temporal activities and the
+# Riot rate limiter, so Redis round-trips never block the event loop.
+_ASYNC_POOL = redis.asyncio.BlockingConnectionPool(
+    **_connection_kwargs(redis.asyncio),
+    db=config.REDIS_DB,
+    max_connections=config.REDIS_MAX_CONNECTIONS,
+    timeout=config.REDIS_POOL_TIMEOUT_SECONDS,
+    decode_responses=False,
+)
+_ASYNC_CLIENT = redis.asyncio.Redis(connection_pool=_ASYNC_POOL)
+
+async def get_async_redis_client(check_connection: bool = False):
+    """
+    Returns the process-wide asyncio Redis client backed by its own shared pool.
+    Pass check_connection=True at startup to fail fast if Redis is unreachable.
+    """
+    if check_connection:
+        try:
+            await _ASYNC_CLIENT.ping()
+        except redis.exceptions.ConnectionError as e:
+            print(f"FATAL: Could not connect to Redis. {e}")
+            raise
+    return _ASYNC_CLIENT
+
+async def close_async_redis_client():
+    """Disconnects the asyncio client's pool. Called once on API and worker shutdown."""
+    await _ASYNC_POOL.disconnect()
 
 # --- CACHE INTERFACE FUNCTIONS ---
 # Note: Every function now accepts 'redis_client' as its first argument.
 
-def get_from_cache(redis_client, key: str) -> list | dict | None:
+# Version prefix for zstd-compressed cache blobs. Legacy entries (a sorted set or
+# plain JSON) are rewritten by migrate_cache.py; reads only tolerate plain JSON.
+CACHE_BLOB_PREFIX = b"z1"
+
+# Reused across calls: building a zstd context costs more than compressing a
+# typical history. Each process uses them from a single thread.
+_ZSTD_COMPRESSOR = zstandard.ZstdCompressor(level=config.CACHE_ZSTD_LEVEL)
+_ZSTD_DECOMPRESSOR = zstandard.ZstdDecompressor()
+
+def _compress_cache_json(json_bytes: bytes) -> bytes:
+    return CACHE_BLOB_PREFIX + _ZSTD_COMPRESSOR.compress(json_bytes)
+
+def _join_json_members(members: list[bytes]) -> bytes:
+    """Joins JSON-encoded sorted-set members into one JSON array, so it parses in a single call."""
+    return b"[" + b",".join(members) + b"]"
+
+def _decompress_cache_blob(blob: bytes) -> bytes:
+    return _ZSTD_DECOMPRESSOR.decompress(blob[len(CACHE_BLOB_PREFIX):])
+
+def _decode_cache_blob(blob: bytes) -> list | dict:
+    return orjson.loads(_decompress_cache_blob(blob))
+
+async def get_from_cache(redis_client, key: str) -> list | dict | None:
+    """Returns the decoded cached value, or None. Takes the asyncio client."""
     if not redis_client: return None
     try:
-        key_type = redis_client.type(key)
-        if key_type == "zset":
-            zset_data = redis_client.zrevrange(key, 0, -1, withscores=False)
-            return [json.loads(member) for member in zset_data] if zset_data else None
-        elif key_type == "string":
-            cached_string = redis_client.get(key)
-            return json.loads(cached_string) if cached_string else None
-        else:
-            print(f"Redis key {key} has unexpected type: {key_type}")
+        cached = await redis_client.get(key)
+        if not cached:
             return None
-    except (redis.exceptions.RedisError, json.JSONDecodeError) as e:
+        if cached.startswith(CACHE_BLOB_PREFIX):
+            return _decode_cache_blob(cached)
+        return orjson.loads(cached)
+    except (redis.exceptions.RedisError, orjson.JSONDecodeError, zstandard.ZstdError) as e:
         print(f"Redis/JSON error for key {key}: {e}")
         return None
 
 
-def get_cached_match_ids(redis_client, key: str) -> set | None:
+def migrate_legacy_cache_entry(redis_client, key: str) -> bool:
     """
-    Efficiently returns a set of match_id strings currently cached at the given key.
-    Returns None on error or if key doesn't exist.
+    Rewrites a legacy cache entry (sorted set of JSON members, or a plain JSON
+    string) as a compressed blob, keeping its expiry. Returns True if the key
+    was migrated, False if it was already current or isn't a cache entry.
     """
+    key_type = redis_client.type(key)
+    if key_type == b"zset":
+        members = redis_client.zrevrange(key, 0, -1, withscores=False)
+        json_bytes = _join_json_members(members) if members else None
+    elif key_type == b"string":
+        cached = redis_client.get(key)
+        json_bytes = None if not cached or cached.startswith(CACHE_BLOB_PREFIX) else cached
+    else:
+        return False
+    if json_bytes is None:
+        return False
+    # SET replaces the sorted set outright; KEEPTTL carries its expiry over.
+    redis_client.set(key, _compress_cache_json(json_bytes), keepttl=True)
+    return True
+
+
+@dataclass
+class PlayerState:
+    """A player's job and cache state, as read by /history in a single round-trip."""
+    cooldown_ttl: int
+    in_progress: bool
+    cached_json: bytes | None
+    stale_at: float | None
+
+
+async def snapshot_player_state(redis_client, player_id: str) -> PlayerState:
+    """
+    Reads the cooldown TTL, the job lock, the cached history (as JSON bytes) and
+    its stale_at timestamp in one pipelined round-trip.
+    """
+    cache_key = key_service.get_cache_key(player_id)
     if not redis_client:
-        return None
+        return PlayerState(-2, False, None, None)
     try:
-        # If the cache key is a zset as used for match lists, iterate members and
-        # extract match_id from the JSON. Using zrange/zrevrange returns list of
-        # JSON strings which we can parse.
-        key_type = redis_client.type(key)
-        if key_type == "zset":
-            members = redis_client.zrevrange(key, 0, -1, withscores=False)
-            ids = set()
-            for m in members:
-                try:
-                    obj = json.loads(m)
-                    if isinstance(obj, dict) and obj.get("match_id"):
-                        ids.add(obj.get("match_id"))
-                except json.JSONDecodeError:
-                    # Skip malformed member but continue processing others
-                    continue
-            return ids if ids else None
-        elif key_type == "string":
-            cached_string = redis_client.get(key)
-            if not cached_string:
-                return None
-            data = json.loads(cached_string)
-            if isinstance(data, list):
-                return {item.get("match_id") for item in data if isinstance(item, dict) and item.get("match_id")}
-            return None
-        else:
-            return None
-    except (redis.exceptions.RedisError, json.JSONDecodeError) as e:
-        print(f"Redis error while getting cached match ids for key {key}: {e}")
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.ttl(key_service.get_cooldown_key(player_id))
+        pipe.exists(key_service.get_lock_key(player_id))
+        pipe.get(cache_key)
+        pipe.hget(key_service.get_cache_meta_key(player_id), "stale_at")
+        # Don't let one bad reply throw away the lock and cooldown state.
+        ttl, lock_exists, cached, stale_at = await pipe.execute(raise_on_error=False)
+        if isinstance(cached, redis.exceptions.ResponseError):
+            # Most likely a legacy sorted-set entry migrate_cache.py hasn't rewritten yet.
+            print(f"Unreadable cache entry for {player_id}, treating it as a miss: {cached}")
+            cached = None
+        return PlayerState(
+            cooldown_ttl=ttl,
+            in_progress=bool(lock_exists),
+            cached_json=_cache_value_to_json(cached),
+            stale_at=float(stale_at) if stale_at else None,
+        )
+    except (redis.exceptions.RedisError, zstandard.ZstdError) as e:
+        print(f"Redis error while reading state for {player_id}: {e}")
+        return PlayerState(-2, False, None, None)
+
+
+def _cache_value_to_json(cached: bytes | None) -> bytes | None:
+    """Turns a stored cache value into JSON bytes (plain-JSON legacy strings pass through)."""
+    if not cached:
         return None
+    if cached.startswith(CACHE_BLOB_PREFIX):
+        return _decompress_cache_blob(cached)
+    return cached
+
 
-def set_in_cache(redis_client, key: str, data: list | dict):
-    if not redis_client or not data: return
+async def get_from_cache_raw(redis_client, key: str) -> bytes | None:
+    """
+    Returns the cached value as serialized JSON bytes, ready to be sent to a client
+    without a parse/re-serialize round-trip. Takes the asyncio client.
+    """
+    if not redis_client: return None
     try:
-        if isinstance(data, list):
-            import time
-            current_time = time.time()
-            redis_client.delete(key)
-            zset_data = {
-                json.dumps(item, default=str): current_time + i
-                for i, item in enumerate(data)
-            }
-            if zset_data:
-                redis_client.zadd(key, zset_data)
-                redis_client.expire(key, config.CACHE_EXPIRATION_SECONDS)
-        else:
-            data_to_cache = json.dumps(data, default=str)
-            redis_client.setex(key, config.CACHE_EXPIRATION_SECONDS, data_to_cache)
-    except redis.exceptions.RedisError as e:
-        print(f"Redis SETEX/ZADD error: {e}")
+        return _cache_value_to_json(await redis_client.get(key))
+    except (redis.exceptions.RedisError, zstandard.ZstdError) as e:
+        print(f"Redis/JSON error for key {key}: {e}")
+        return None
+
 
-def set_cooldown(redis_client, key: str, cooldown_seconds: int = 120):
-    if not redis_client: return
+async def get_cached_matches(redis_client, player_id: str, match_ids: list[str]) -> tuple[list, list]:
+    """
+    Looks up cached matches by id with a single HMGET on the player's match hash.
+    Returns (existing_match_objects, missing_match_ids), both in input order.
+    Takes the asyncio client.
+    """
+    if not match_ids:
+        return [], []
+    raw = await redis_client.hmget(key_service.get_match_index_key(player_id), match_ids)
+    # Each value is a JSON object, so the hits parse as one array in a single call.
+    hits = [x for x in raw if x]
+    existing = orjson.loads(_join_json_members(hits)) if hits else []
+    missing = [mid for mid, x in zip(match_ids, raw) if x is None]
+    return existing, missing
+
+
+async def save_player_results(redis_client, player_id: str, matches: list):
+    """
+    Writes a finished job's results in one MULTI/EXEC round-trip: the compressed
+    history blob, each match in the player's match hash (keyed by match_id) and
+    the cache's generated_at/stale_at timestamps. Each match is serialized once
+    and the history blob is assembled from those bytes.
+    Errors are raised so callers (e.g. Temporal activities) can retry.
+    Takes the asyncio client.
+    """
+    if not redis_client or not matches:
+        return
+    encoded = [
+        (match.get("match_id"), orjson.dumps(match, default=str))
+        for match in matches
+        if isinstance(match, dict)
+    ]
+    mapping = {match_id: match_json for match_id, match_json in encoded if match_id}
+    now = time.time()
+    index_key = key_service.get_match_index_key(player_id)
+    meta_key = key_service.get_cache_meta_key(player_id)
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.set(
+        key_service.get_cache_key(player_id),
+        _compress_cache_json(_join_json_members([match_json for _, match_json in encoded])),
+        ex=config.CACHE_EXPIRATION_SECONDS,
+    )
+    # Replace the hash rather than add to it, so matches that left the history go too.
+    pipe.delete(index_key)
+    if mapping:
+        pipe.hset(index_key, mapping=mapping)
+        pipe.expire(index_key, config.CACHE_EXPIRATION_SECONDS)
+    pipe.hset(meta_key, mapping={"generated_at": now, "stale_at": now + config.CACHE_FRESH_SECONDS})
+    pipe.expire(meta_key, config.CACHE_EXPIRATION_SECONDS)
+    await pipe.execute()
+
+async def acquire_update_lock(redis_client, cooldown_key: str, lock_key: str, lock_timeout_seconds: int) -> tuple[str, int]:
+    """
+    Atomically checks the player's cooldown and acquires the job lock.
+    Returns ("acquired" | "in_progress" | "cooldown", cooldown_ttl_seconds).
+    Errors are raised so the API can report them. Takes the asyncio client.
+    """
+    script = _get_script(redis_client, _ACQUIRE_UPDATE_LOCK_LUA)
+    state, ttl = await script(keys=[cooldown_key, lock_key], args=[lock_timeout_seconds], client=redis_client)
+    return state.decode(), int(ttl)
+
+async def release_lock(redis_client, key: str):
+    """
+    Releases a distributed lock in Redis.
+    Takes the asyncio client.
+    """
+    if not redis_client:
+        return
     try:
-        redis_client.setex(key, cooldown_seconds, 1)
+        await redis_client.delete(key)
     except redis.exceptions.RedisError as e:
-        print(f"Redis SETEX error for cooldown: {e}")
+        print(f"Redis DEL error for lock: {e}")
 
-def get_cooldown_ttl(redis_client, key: str) -> int:
+async def renew_lock(redis_client, lock_key: str, ttl_seconds: int) -> bool:
     """
-    Checks the remaining time-to-live (TTL) for a cooldown key.
-    Now accepts a redis_client instance.
+    Pushes a held lock's TTL back up to ttl_seconds; returns True if it was raised.
+    Errors are raised to the caller. Takes the asyncio client.
+    """
+    script = _get_script(redis_client, _RENEW_LOCK_LUA)
+    return bool(await script(keys=[lock_key], args=[ttl_seconds], client=redis_client))
+
+async def acquire_riot_token(redis_client) -> int:
+    """
+    Takes one request from the global Riot API budget.
+    Returns 0 if the request may proceed, otherwise the milliseconds to wait
+    until the oldest request in the window ages out. Takes the asyncio client.
     """
     if not redis_client:
-        return -2
+        return 0
     try:
-        return redis_client.ttl(key)
+        script = _get_script(redis_client, _RIOT_TOKEN_LUA)
+        return int(await script(
+            keys=[key_service.RIOT_RATE_LIMIT_KEY],
+            args=[config.RIOT_RATE_LIMIT_WINDOW_MS, config.RIOT_RATE_LIMIT_MAX_REQUESTS, uuid.uuid4().hex],
+            client=redis_client,
+        ))
     except redis.exceptions.RedisError as e:
-        print(f"Redis TTL error: {e}")
-        return -2
+        print(f"Redis error while acquiring Riot API token: {e}")
+        return 0
 
-def acquire_lock(redis_client, key: str, lock_timeout_seconds: int = 90) -> bool:
+async def release_lock_and_set_cooldown(
+    redis_client, lock_key: str, cooldown_key: str, cooldown_seconds: int, done_channel: str | None = None
+):
     """
-    Tries to acquire a distributed lock in Redis.
-    Now accepts a redis_client instance.
+    Deletes the job lock and sets the cooldown in one server-side script,
+    publishing to done_channel (if given) so waiting requests wake up.
+    Errors are raised so callers (e.g. Temporal activities) can retry.
+    Takes the asyncio client.
     """
-    if not redis_client:
-        return False
-    return redis_client.set(key, 1, ex=lock_timeout_seconds, nx=True)
+    keys = [lock_key, cooldown_key] + ([done_channel] if done_channel else [])
+    script = _get_script(redis_client, _RELEASE_AND_COOLDOWN_LUA)
+    await script(keys=keys, args=[cooldown_seconds], client=redis_client)
 
-def release_lock(redis_client, key: str):
+async def publish_progress(redis_client, progress_channel: str, count: int = 1):
     """
-    Releases a distributed lock in Redis.
-    Now accepts a redis_client instance.
+    Announces that count more matches of a running job have been processed.
+    Takes the asyncio client.
     """
     if not redis_client:
         return
     try:
-        redis_client.delete(key)
+        await redis_client.publish(progress_channel, count)
     except redis.exceptions.RedisError as e:
-        print(f"Redis DEL error for lock: {e}")
\ No newline at end of file
+        print(f"Redis PUBLISH error for progress: {e}")
+
+class ChannelSubscription:
+    """A listener's queue of messages from a ChannelHub."""
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def _deliver(self, message: dict):
+        self._queue.put_nowait(message)
+
+    async def get_message(self, timeout: float) -> dict | None:
+        """Returns the next message, or None if none arrives within timeout seconds."""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class ChannelHub:
+    """
+    A single Pub/Sub connection per process that pattern-subscribes to every
+    job channel and fans messages out to local subscriptions. Open status
+    streams and waiting requests then cost a queue each, not a pooled connection.
+    """
+
+    def __init__(self, patterns: tuple[str, ...]):
+        self._patterns = patterns
+        self._subscriptions: dict[bytes, set[ChannelSubscription]] = {}
+        self._task: asyncio.Task | None = None
+
+    def start(self, redis_client):
+        """Starts the background reader. Takes the asyncio client."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(redis_client))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @asynccontextmanager
+    async def subscribe(self, *channels: str):
+        """Yields a ChannelSubscription receiving messages published to channels."""
+        subscription = ChannelSubscription()
+        keys = [channel.encode() for channel in channels]
+        for key in keys:
+            self._subscriptions.setdefault(key, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            for key in keys:
+                subscribers = self._subscriptions.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[key]
+
+    async def _run(self, redis_client):
+        while True:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(*self._patterns)
+                async for message in pubsub.listen():
+                    for subscription in self._subscriptions.get(message["channel"], ()):
+                        subscription._deliver(message)
+            except redis.exceptions.RedisError as e:
+                # Subscribers fall back to their own timeouts while we reconnect.
+                print(f"Redis Pub/Sub error, resubscribing: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+
+channel_hub = ChannelHub(key_service.JOB_CHANNEL_PATTERNS)
+
+
+async def wait_for_job_completion(redis_client, done_channel: str, lock_key: str, timeout_seconds: float) -> bool:
+    """
+    Waits until the job holding lock_key announces completion on done_channel.
+    Returns True if it finished (or already had), False on timeout.
+    Takes the asyncio client; messages arrive through channel_hub.
+    """
+    async with channel_hub.subscribe(done_channel) as subscription:
+        # The job may have finished before we subscribed.
+        if not await redis_client.exists(lock_key):
+            return True
+        return await subscription.get_message(timeout=timeout_seconds) is not None
@@ -1,8 +1,15 @@
 import httpx
+import msgspec
+import orjson
+import asyncio
+import logging
+import time
+from collections import deque
 from datetime import datetime
-import config
+import redis_service
 
-HEADERS = {"X-Riot-Token": config.RIOT_API_KEY}
+# Backoff schedule (seconds) used when Riot answers with HTTP 429.
+RETRY_BACKOFF_SECONDS = (0.5, 1, 2, 4)
 
 REGION_TO_ROUTE_MAP = {
     "na": "americas",
@@ -17,6 +24,10 @@ PLATFORM_ID_MAP = {
     "kr": "kr", "jp": "jp1",
     # Add other platforms as needed based on what you support
 }
+# Regional base URLs, built once instead of on every request.
+REGIONAL_BASE_URLS = {
+    region: f"https://{route}.api.riotgames.com" for region, route in REGION_TO_ROUTE_MAP.items()
+}
 
 async def validate_player_in_region_async(
     client: httpx.AsyncClient, game_name: str, tag_line: str, region: str
@@ -36,7 +47,7 @@ async def validate_player_in_region_async(
             raise PlayerNotFound(f"Region '{region}' does not have a configured platform for summoner lookups.")
 
         summoner_url = f"https://{platform_id}.api.riotgames.com/lol/summoner/v4/summoners/by-puuid/{puuid}"
-        response = await client.get(summoner_url, headers=HEADERS)
+        response = await _get(client, summoner_url)
         response.raise_for_status()
         
         # If both checks pass, return the PUUID
@@ -49,15 +60,35 @@ async def validate_player_in_region_async(
             ) from e
         raise # Re-raise other HTTP errors
     
-def get_regional_route(region: str) -> str:
+def get_regional_base_url(region: str) -> str:
     """
-    Converts a simple region string (e.g., 'na') to its regional route.
+    Converts a simple region string (e.g., 'na') to its regional API base URL.
     Raises PlayerNotFound if the region is not supported.
     """
-    route = REGION_TO_ROUTE_MAP.get(region.lower())
-    if not route:
+    base_url = REGIONAL_BASE_URLS.get(region) or REGIONAL_BASE_URLS.get(region.lower())
+    if not base_url:
         raise PlayerNotFound(f"Invalid or unsupported region: '{region}'")
-    return route
+    return base_url
+
+class MatchParticipant(msgspec.Struct):
+    puuid: str
+    win: bool
+    championName: str
+    teamPosition: str
+
+
+class MatchInfo(msgspec.Struct):
+    gameCreation: int
+    participants: list[MatchParticipant]
+
+
+class MatchDocument(msgspec.Struct):
+    """The parts of a match-v5 document we use; every other field is skipped while parsing."""
+    info: MatchInfo
+
+
+_match_decoder = msgspec.json.Decoder(MatchDocument)
+
 
 class PlayerNotFound(Exception):
     """Custom exception for when a player's PUUID can't be found."""
@@ -65,16 +96,141 @@ class PlayerNotFound(Exception):
     pass
 
 
+def _parse_rate_limit_header(value: str | None) -> list[tuple[int, int]]:
+    """Parses a Riot rate-limit header such as '20:1,100:120' into (count, window) pairs."""
+    if not value:
+        return []
+    pairs = []
+    for part in value.split(","):
+        count, _, window = part.partition(":")
+        try:
+            pairs.append((int(count), int(window)))
+        except ValueError:
+            continue
+    return pairs
+
+
+class RateLimiter:
+    """
+    Sliding-window limiter for the Riot API.
+    Starts from the documented development-key limits and adopts whatever
+    limits Riot reports in the X-App-Rate-Limit response headers. Every
+    request also takes a token from the Redis-backed budget shared by all
+    workers, so scaling out doesn't overshoot Riot's global limit.
+
+    Callers take turns, one at a time. Bulk requests (match details) only get
+    a turn when no other request is waiting, so a player lookup never queues
+    behind a large refresh's backlog of match fetches.
+    """
+
+    def __init__(self, limits: list[tuple[int, int]] | None = None):
+        self._limits = limits or [(20, 1), (100, 120)]
+        self._timestamps: deque[float] = deque()
+        self._blocked_until = 0.0
+        self._busy = False
+        self._waiting: deque[asyncio.Future] = deque()
+        self._bulk_waiting: deque[asyncio.Future] = deque()
+        self._redis = None
+
+    def _seconds_until_free(self, now: float) -> float:
+        wait = self._blocked_until - now
+        for count, window in self._limits:
+            if len(self._timestamps) >= count:
+                oldest_in_window = self._timestamps[-count]
+                wait = max(wait, oldest_in_window + window - now)
+        return wait
+
+    async def acquire(self, bulk: bool = False):
+        """
+        Waits until a request can be sent without exceeding any known limit.
+        Pass bulk=True for requests that may yield to everything else.
+        """
+        await self._take_turn(bulk)
+        try:
+            while (wait := self._seconds_until_free(time.monotonic())) > 0:
+                await asyncio.sleep(wait)
+            await self._acquire_global_token()
+            now = time.monotonic()
+            self._timestamps.append(now)
+            longest_window = max(window for _, window in self._limits)
+            while self._timestamps and self._timestamps[0] <= now - longest_window:
+                self._timestamps.popleft()
+        finally:
+            self._pass_turn()
+
+    async def _take_turn(self, bulk: bool):
+        if not self._busy:
+            self._busy = True
+            return
+        turn = asyncio.get_running_loop().create_future()
+        (self._bulk_waiting if bulk else self._waiting).append(turn)
+        try:
+            await turn
+        except asyncio.CancelledError:
+            # If the turn was handed over just before the cancellation, pass it on.
+            if turn.done() and not turn.cancelled():
+                self._pass_turn()
+            raise
+
+    def _pass_turn(self):
+        for queue in (self._waiting, self._bulk_waiting):
+            while queue:
+                turn = queue.popleft()
+                if not turn.done():
+                    turn.set_result(None)
+                    return
+        self._busy = False
+
+    async def _acquire_global_token(self):
+        if self._redis is None:
+            self._redis = await redis_service.get_async_redis_client()
+        while (wait_ms := await redis_service.acquire_riot_token(self._redis)) > 0:
+            await asyncio.sleep(wait_ms / 1000)
+
+    def update_from_headers(self, headers: httpx.Headers):
+        """Syncs the limiter with the limits and usage counts Riot reports."""
+        if limits := _parse_rate_limit_header(headers.get("X-App-Rate-Limit")):
+            self._limits = limits
+        now = time.monotonic()
+        limit_by_window = {window: count for count, window in self._limits}
+        for used, window in _parse_rate_limit_header(headers.get("X-App-Rate-Limit-Count")):
+            # Riot's count includes requests we didn't see (other processes, restarts).
+            # If its bucket is already full, hold off for the whole window.
+            if window in limit_by_window and used >= limit_by_window[window]:
+                self._blocked_until = max(self._blocked_until, now + window)
+
+
+rate_limiter = RateLimiter()
+
+
+async def _get(client: httpx.AsyncClient, url: str, bulk: bool = False) -> httpx.Response:
+    """
+    Sends a rate-limited GET to the Riot API.
+    Retries on HTTP 429, honouring Retry-After with exponential backoff.
+    bulk=True lets other waiting requests go first (see RateLimiter).
+    """
+    for attempt in range(len(RETRY_BACKOFF_SECONDS) + 1):
+        await rate_limiter.acquire(bulk)
+        response = await client.get(url)
+        rate_limiter.update_from_headers(response.headers)
+        if response.status_code != 429 or attempt == len(RETRY_BACKOFF_SECONDS):
+            return response
+        backoff = RETRY_BACKOFF_SECONDS[attempt]
+        retry_after = float(response.headers.get("Retry-After", backoff))
+        logging.warning(f"Rate limited by Riot API, retrying in {max(retry_after, backoff)}s")
+        await asyncio.sleep(max(retry_after, backoff))
+
+
 async def get_puuid(
     client: httpx.AsyncClient, game_name: str, tag_line: str, platform_id: str
 ) -> str:
     """Fetches a player's PUUID. Raises PlayerNotFound on 404."""
-    regional_route = get_regional_route(platform_id)
-    url = f"https://{regional_route}.api.riotgames.com/riot/account/v1/accounts/by-riot-id/{game_name}/{tag_line}"
+    base_url = get_regional_base_url(platform_id)
+    url = f"{base_url}/riot/account/v1/accounts/by-riot-id/{game_name}/{tag_line}"
     try:
-        response = await client.get(url, headers=HEADERS)
+        response = await _get(client, url)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         if not data.get("puuid"):
             raise PlayerNotFound("PUUID not found in response.")
         return data["puuid"]
@@ -94,12 +250,12 @@ async def get_match_ids_async(
     platform_id: str,
 ) -> list | None:
     """Asynchronously fetches a list of match IDs."""
-    regional_route = get_regional_route(platform_id)
-    url = f"https://{regional_route}.api.riotgames.com/lol/match/v5/matches/by-puuid/{puuid}/ids?queue=420&start={start_index}&count={count}"
+    base_url = get_regional_base_url(platform_id)
+    url = f"{base_url}/lol/match/v5/matches/by-puuid/{puuid}/ids?queue=420&start={start_index}&count={count}"
     try:
-        response = await client.get(url, headers=HEADERS)
+        response = await _get(client, url)
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except httpx.RequestError as e:
         print(f"Error fetching match IDs: {e}")
         return None
@@ -109,24 +265,28 @@ async def get_match_details_async(
     client: httpx.AsyncClient, match_id: str, puuid: str, platform_id: str
 ) -> dict | None:
     """Asynchronously fetches detailed information for a single match."""
-    regional_route = get_regional_route(platform_id)
-    url = f"https://{regional_route}.api.riotgames.com/lol/match/v5/matches/{match_id}"
+    base_url = get_regional_base_url(platform_id)
+    url = f"{base_url}/lol/match/v5/matches/{match_id}"
     try:
-        response = await client.get(url, headers=HEADERS)
+        response = await _get(client, url, bulk=True)
+        logging.debug(f"Match {match_id} fetched over {response.http_version}")
         response.raise_for_status()
-        data = response.json()
+        # Decode only the fields we keep; the rest of the (large) match document
+        # is skipped rather than built into dicts. Drop the raw body right away.
+        info = _match_decoder.decode(response.content).info
+        del response
         player_data = next(
-            (p for p in data["info"]["participants"] if p["puuid"] == puuid), None
+            (p for p in info.participants if p.puuid == puuid), None
         )
-        if player_data:
-            return {
-                "match_id": match_id,
-                "timestamp": data["info"]["gameCreation"],
-                "outcome": "Win" if player_data["win"] else "Loss",
-                "champion": player_data["championName"],
-                "role": player_data["teamPosition"],
-            }
-        return None
+        if not player_data:
+            return None
+        return {
+            "match_id": match_id,
+            "timestamp": info.gameCreation,
+            "outcome": "Win" if player_data.win else "Loss",
+            "champion": player_data.championName,
+            "role": player_data.teamPosition,
+        }
     except (httpx.RequestError, httpx.HTTPStatusError) as e:
         print(f"HTTP error fetching details for match {match_id}: {e}")
         return None
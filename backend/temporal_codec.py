@@ -0,0 +1,50 @@
+import dataclasses
+from typing import Sequence
+
+import temporalio.converter
+import zstandard
+from temporalio.api.common.v1 import Payload
+
+import config
+
+ZSTD_ENCODING = b"binary/zstd"
+
+
+class ZstdPayloadCodec(temporalio.converter.PayloadCodec):
+    """
+    Compresses large Temporal payloads (activity arguments and results, such as
+    batches of match summaries) before they are stored in workflow history.
+    Small payloads and payloads written before compression was enabled pass
+    through unchanged, so existing histories still replay.
+    """
+
+    def __init__(self, min_bytes: int = config.TEMPORAL_PAYLOAD_COMPRESSION_MIN_BYTES):
+        self._min_bytes = min_bytes
+        self._compressor = zstandard.ZstdCompressor(level=config.CACHE_ZSTD_LEVEL)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    async def encode(self, payloads: Sequence[Payload]) -> list[Payload]:
+        return [self._encode(payload) for payload in payloads]
+
+    async def decode(self, payloads: Sequence[Payload]) -> list[Payload]:
+        return [self._decode(payload) for payload in payloads]
+
+    def _encode(self, payload: Payload) -> Payload:
+        if payload.ByteSize() < self._min_bytes:
+            return payload
+        return Payload(
+            metadata={"encoding": ZSTD_ENCODING},
+            data=self._compressor.compress(payload.SerializeToString()),
+        )
+
+    def _decode(self, payload: Payload) -> Payload:
+        if payload.metadata.get("encoding") != ZSTD_ENCODING:
+            return payload
+        return Payload.FromString(self._decompressor.decompress(payload.data))
+
+
+# Both the API and the worker must connect with this converter so they can read
+# each other's payloads.
+DATA_CONVERTER = dataclasses.replace(
+    temporalio.converter.default(), payload_codec=ZstdPayloadCodec()
+)
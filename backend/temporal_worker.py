@@ -8,12 +8,16 @@ from temporalio.common import WorkerDeploymentVersion, VersioningBehavior
 
 import config
 import redis_service
+import key_service
+import http_clients
+import temporal_codec
 from temporal_workflows import FetchMatchHistoryWorkflow
 from activities import (
     get_puuid_activity,
     get_match_ids_activity,
     filter_cached_matches_activity,
     get_match_details_activity,
+    get_match_details_batch_activity,
     save_results_to_cache_activity,
     extend_lock_activity,
     release_and_cleanup_activity,
@@ -22,13 +26,13 @@ from activities import (
 logging.basicConfig(level=logging.INFO)
 
 BUILD_ID = os.getenv("TEMPORAL_WORKER_BUILD_ID", f"dev-{time.time()}")
-HEARTBEAT_KEY = f"worker:heartbeat:{config.TEMPORAL_TASK_QUEUE}"
+HEARTBEAT_KEY = key_service.get_worker_heartbeat_key(config.TEMPORAL_TASK_QUEUE)
 
-async def periodic_heartbeat(redis_client: redis_service.redis.Redis, interval_seconds: int = 30):
+async def periodic_heartbeat(redis_client: redis_service.redis.asyncio.Redis, interval_seconds: int = 30):
     """A background task to write a heartbeat to Redis periodically."""
     while True:
         try:
-            redis_client.set(HEARTBEAT_KEY, time.time(), ex=interval_seconds * 2)
+            await redis_client.set(HEARTBEAT_KEY, time.time(), ex=interval_seconds * 2)
             logging.info(f"Worker heartbeat sent to Redis key '{HEARTBEAT_KEY}'.")
         except redis_service.redis.exceptions.RedisError as e:
             logging.error(f"Could not send worker heartbeat: {e}")
@@ -39,7 +43,7 @@ async def main():
     last_exception = None
     
     try:
-        redis_for_heartbeat = redis_service.get_redis_client()
+        redis_for_heartbeat = await redis_service.get_async_redis_client(check_connection=True)
         logging.info("Successfully connected to Redis for worker heartbeat.")
     except Exception as e:
         logging.error(f"FATAL: Worker could not connect to Redis: {e}")
@@ -47,7 +51,9 @@ async def main():
 
     for attempt in range(5):
         try:
-            client = await Client.connect(f"{config.TEMPORAL_HOST}:7233")
+            client = await Client.connect(
+                f"{config.TEMPORAL_HOST}:7233", data_converter=temporal_codec.DATA_CONVERTER
+            )
             logging.info("Successfully connected to Temporal server.")
             last_exception = None
             break
@@ -70,10 +76,14 @@ async def main():
         api_activities = [
             get_puuid_activity,
             get_match_ids_activity,
-            filter_cached_matches_activity,
             get_match_details_activity,
+            get_match_details_batch_activity,
+            # Still scheduled here by workflows started before the batched fetch.
+            filter_cached_matches_activity,
         ]
+        # Redis-only activities; they never wait behind Riot API calls.
         internal_activities = [
+            filter_cached_matches_activity,
             save_results_to_cache_activity,
             extend_lock_activity,
             release_and_cleanup_activity,
@@ -84,7 +94,7 @@ async def main():
             client,
             task_queue=config.TEMPORAL_TASK_QUEUE,
             activities=api_activities,
-            max_concurrent_activities=1,
+            max_concurrent_activities=config.API_WORKER_MAX_CONCURRENT_ACTIVITIES,
             workflows=[FetchMatchHistoryWorkflow],
             deployment_config=WorkerDeploymentConfig(
                 version=WorkerDeploymentVersion(
@@ -117,6 +127,9 @@ async def main():
 
     finally:
         heartbeat_task.cancel()
+        # Close the shared Riot API client so pooled connections are torn down cleanly.
+        await http_clients.close_riot_client()
+        await redis_service.close_async_redis_client()
         if client:
             await client.disconnect()
         try:
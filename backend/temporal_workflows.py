@@ -1,5 +1,7 @@
 import asyncio
 from datetime import timedelta
+from itertools import chain
+from operator import itemgetter
 from temporalio import workflow
 from temporalio.common import RetryPolicy, Priority
 
@@ -18,26 +20,19 @@ class FetchMatchHistoryWorkflow:
     @workflow.run
     async def run(self, game_name: str, tag_line: str, region: str) -> str:
         player_id = key_service.get_player_id(game_name, tag_line, region)
-        cache_key = key_service.get_cache_key(player_id)
         lock_key = key_service.get_lock_key(player_id)
         cooldown_key = key_service.get_cooldown_key(player_id)
+        progress_channel = key_service.get_progress_channel(player_id)
+        done_channel = key_service.get_done_channel(player_id)
         INTERNAL_TASK_QUEUE = config.INTERNAL_TASK_QUEUE
-
-        # --- Heartbeat Logic ---
-        # We'll extend the lock periodically from the main workflow logic
-        # rather than spawning a background asyncio task. Spawning raw
-        # asyncio tasks inside a Temporal workflow breaks determinism
-        # and can cause replay issues. Use the workflow clock instead.
-        heartbeat_interval_seconds = 60
-        lock_ttl_seconds = config.LOCK_TIMEOUT_SECONDS
-        # Track when we last extended the lock using the workflow clock.
         last_heartbeat_time = workflow.now()
-        
+
         try:
             puuid = await workflow.execute_activity(
                 "get_puuid_activity",
                 args=[game_name, tag_line, region],
-                start_to_close_timeout=timedelta(seconds=30),
+                # Riot calls can wait up to a full rate-limit window for a token.
+                start_to_close_timeout=timedelta(minutes=3),
                 retry_policy=RetryPolicy(maximum_attempts=3),
             )
             
@@ -45,7 +40,7 @@ class FetchMatchHistoryWorkflow:
                 "get_match_ids_activity",
                 args=[puuid, region],
                 start_to_close_timeout=timedelta(minutes=10),
-                heartbeat_timeout=timedelta(seconds=30),
+                heartbeat_timeout=timedelta(minutes=3),
                 retry_policy=RetryPolicy(maximum_attempts=3),
             )
 
@@ -54,12 +49,18 @@ class FetchMatchHistoryWorkflow:
                 return "Completed: No matches found."
             self._total = len(match_ids)
 
+            # Workflows started before match details were batched replay their
+            # original commands: cache filter on the API queue, one activity per
+            # match and periodic lock extensions.
+            batched = workflow.patched("batched-match-details")
+
             # Filter cached matches so we only fetch details for missing IDs
             filter_result = await workflow.execute_activity(
                 "filter_cached_matches_activity",
-                args=[key_service.get_cache_key(player_id), match_ids],
+                args=[player_id, match_ids],
                 start_to_close_timeout=timedelta(seconds=30),
                 retry_policy=RetryPolicy(maximum_attempts=3),
+                task_queue=INTERNAL_TASK_QUEUE if batched else None,
             )
 
             existing_matches = filter_result.get("existing", []) or []
@@ -68,60 +69,85 @@ class FetchMatchHistoryWorkflow:
             # Count cached items as already processed for progress reporting
             self._processed = len(existing_matches)
 
-            fetch_tasks = []
-            for match_id in missing_ids:
-                task = workflow.execute_activity(
-                    "get_match_details_activity",
-                    args=[match_id, puuid, region],
-                    start_to_close_timeout=timedelta(minutes=5),
-                    retry_policy=RetryPolicy(maximum_attempts=3),
-                )
-                fetch_tasks.append(task)
-            
-            match_details_results = []
-            for future in asyncio.as_completed(fetch_tasks):
-                result = await future
-                if result is not None:
-                    match_details_results.append(result)
-
-                # Update processed count for the query hook.
-                self._processed += 1
-
-                # Periodically extend the external Redis lock so it doesn't
-                # expire while we're still processing. Use the workflow
-                # clock to decide when to extend.
-                now = workflow.now()
-                elapsed = (now - last_heartbeat_time).total_seconds()
-                if elapsed >= heartbeat_interval_seconds:
-                    workflow.logger.info(f"Extending lock for {player_id} after {int(elapsed)}s")
-                    await workflow.execute_activity(
-                        "extend_lock_activity",
-                        args=[lock_key, lock_ttl_seconds],
-                        start_to_close_timeout=timedelta(seconds=10),
+            if batched:
+                # Only a few batches are scheduled at a time, so one large refresh doesn't
+                # queue all of its batches ahead of other players' jobs.
+                batch_slots = asyncio.Semaphore(config.MATCH_DETAILS_BATCHES_IN_FLIGHT)
+
+                async def fetch_batch(batch: list[str]) -> tuple[int, list]:
+                    async with batch_slots:
+                        results = await workflow.execute_activity(
+                            "get_match_details_batch_activity",
+                            args=[batch, puuid, region, progress_channel, lock_key],
+                            start_to_close_timeout=timedelta(minutes=15),
+                            heartbeat_timeout=timedelta(minutes=3),
+                            retry_policy=RetryPolicy(maximum_attempts=3),
+                        )
+                    return len(batch), results
+
+                # Fetch missing details in batches rather than one activity per match,
+                # which keeps workflow history small and lets each batch share connections.
+                batch_size = config.MATCH_DETAILS_BATCH_SIZE
+                fetch_tasks = [
+                    fetch_batch(missing_ids[start:start + batch_size])
+                    for start in range(0, len(missing_ids), batch_size)
+                ]
+
+                match_details_results = []
+                # workflow.as_completed yields in a replay-safe order, unlike asyncio's.
+                for future in workflow.as_completed(fetch_tasks):
+                    batch_count, results = await future
+                    match_details_results.extend(results)
+
+                    # Update processed count for the query hook.
+                    self._processed += batch_count
+            else:
+                fetch_tasks = [
+                    workflow.execute_activity(
+                        "get_match_details_activity",
+                        args=[match_id, puuid, region],
+                        start_to_close_timeout=timedelta(minutes=5),
                         retry_policy=RetryPolicy(maximum_attempts=3),
-                        task_queue=INTERNAL_TASK_QUEUE,
                     )
-                    last_heartbeat_time = workflow.now()
+                    for match_id in missing_ids
+                ]
+
+                match_details_results = []
+                for future in asyncio.as_completed(fetch_tasks):
+                    result = await future
+                    if result is not None:
+                        match_details_results.append(result)
+                    self._processed += 1
+
+                    if (workflow.now() - last_heartbeat_time).total_seconds() >= 60:
+                        await workflow.execute_activity(
+                            "extend_lock_activity",
+                            args=[lock_key, config.LOCK_TIMEOUT_SECONDS],
+                            start_to_close_timeout=timedelta(seconds=10),
+                            retry_policy=RetryPolicy(maximum_attempts=3),
+                            task_queue=INTERNAL_TASK_QUEUE,
+                        )
+                        last_heartbeat_time = workflow.now()
+                    await workflow.sleep(0)
 
-                # Yield control to the workflow runtime to keep things cooperative.
-                await workflow.sleep(0)
-            
             # Merge cached and newly fetched results. Deduplicate on match_id.
             combined = []
             seen = set()
             # Add newly fetched first (they're more likely to be fresh), then cached ones
-            for item in (match_details_results + existing_matches):
+            for item in chain(match_details_results, existing_matches):
                 mid = item.get("match_id") if isinstance(item, dict) else None
                 if not mid or mid in seen:
                     continue
                 seen.add(mid)
+                # Guarantee the sort key once here so the sort can use itemgetter.
+                item.setdefault("timestamp", 0)
                 combined.append(item)
 
-            combined.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
+            combined.sort(key=itemgetter("timestamp"), reverse=True)
 
             await workflow.execute_activity(
                 "save_results_to_cache_activity",
-                args=[cache_key, combined],
+                args=[player_id, combined],
                 start_to_close_timeout=timedelta(seconds=30),
                 retry_policy=RetryPolicy(maximum_attempts=3),
                 task_queue=INTERNAL_TASK_QUEUE,
@@ -135,13 +161,10 @@ class FetchMatchHistoryWorkflow:
             self._final_status = "failed"
             return f"Workflow failed: {e}"
         finally:
-            # No background heartbeat task to cancel; lock cleanup is handled
-            # via the dedicated activity in the finally block below.
-            
             # Use a dedicated, reliable activity to release the lock and set the cooldown
             await workflow.execute_activity(
                 "release_and_cleanup_activity",
-                args=[lock_key, cooldown_key, config.COOLDOWN_SECONDS],
+                args=[lock_key, cooldown_key, config.COOLDOWN_SECONDS, done_channel],
                 start_to_close_timeout=timedelta(seconds=15),
                 retry_policy=RetryPolicy(maximum_attempts=5),
                 task_queue=INTERNAL_TASK_QUEUE,
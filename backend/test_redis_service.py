@@ -0,0 +1,174 @@
+import unittest
+from unittest import mock
+
+import fakeredis
+import fakeredis.aioredis
+import orjson
+
+import activities
+import config
+import key_service
+import redis_service
+
+PLAYER_ID = "faker#kr1@kr"
+
+
+def match(match_id: str, timestamp: int) -> dict:
+    return {"match_id": match_id, "timestamp": timestamp, "outcome": "Win", "champion": "Ahri", "role": "MIDDLE"}
+
+
+class CacheTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.redis = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())
+
+    async def asyncTearDown(self):
+        await self.redis.aclose()
+
+    async def test_saved_results_read_back(self):
+        matches = [match("EUW_2", 200), match("EUW_1", 100)]
+        await redis_service.save_player_results(self.redis, PLAYER_ID, matches)
+
+        existing, missing = await redis_service.get_cached_matches(self.redis, PLAYER_ID, ["EUW_1", "EUW_3"])
+        self.assertEqual(existing, [matches[1]])
+        self.assertEqual(missing, ["EUW_3"])
+
+        cached_json = await redis_service.get_from_cache_raw(self.redis, key_service.get_cache_key(PLAYER_ID))
+        self.assertEqual(orjson.loads(cached_json), matches)
+
+        state = await redis_service.snapshot_player_state(self.redis, PLAYER_ID)
+        self.assertEqual(orjson.loads(state.cached_json), matches)
+        self.assertIsNotNone(state.stale_at)
+
+    async def test_save_replaces_match_hash(self):
+        await redis_service.save_player_results(self.redis, PLAYER_ID, [match("EUW_2", 200), match("EUW_1", 100)])
+        await redis_service.save_player_results(self.redis, PLAYER_ID, [match("EUW_2", 200)])
+
+        index_key = key_service.get_match_index_key(PLAYER_ID)
+        self.assertEqual(await self.redis.hkeys(index_key), [b"EUW_2"])
+        self.assertGreater(await self.redis.ttl(index_key), 0)
+
+    async def test_snapshot_treats_legacy_zset_as_miss(self):
+        await self.redis.zadd(key_service.get_cache_key(PLAYER_ID), {orjson.dumps(match("EUW_1", 100)): 100})
+        await self.redis.set(key_service.get_lock_key(PLAYER_ID), "1")
+        await self.redis.set(key_service.get_cooldown_key(PLAYER_ID), "1", ex=60)
+
+        state = await redis_service.snapshot_player_state(self.redis, PLAYER_ID)
+        self.assertIsNone(state.cached_json)
+        self.assertTrue(state.in_progress)
+        self.assertGreater(state.cooldown_ttl, 0)
+
+    async def filter_matches(self, player_id: str, match_ids: list[str]) -> dict:
+        with mock.patch.object(redis_service, "get_async_redis_client", mock.AsyncMock(return_value=self.redis)):
+            return await activities.filter_cached_matches_activity(player_id, match_ids)
+
+    async def test_filter_falls_back_to_legacy_blob_without_match_hash(self):
+        blob = redis_service._compress_cache_json(orjson.dumps([match("EUW_1", 100)]))
+        await self.redis.set(key_service.get_cache_key(PLAYER_ID), blob)
+
+        result = await self.filter_matches(PLAYER_ID, ["EUW_1", "EUW_9"])
+        self.assertEqual(result, {"existing": [match("EUW_1", 100)], "missing_ids": ["EUW_9"]})
+
+    async def test_filter_skips_legacy_blob_when_match_hash_exists(self):
+        await redis_service.save_player_results(self.redis, PLAYER_ID, [match("EUW_1", 100)])
+        # A blob entry the hash doesn't have must not be picked up.
+        blob = redis_service._compress_cache_json(orjson.dumps([match("EUW_9", 900)]))
+        await self.redis.set(key_service.get_cache_key(PLAYER_ID), blob)
+
+        result = await self.filter_matches(PLAYER_ID, ["EUW_9"])
+        self.assertEqual(result, {"existing": [], "missing_ids": ["EUW_9"]})
+
+    async def test_filter_accepts_old_cache_key_argument(self):
+        await redis_service.save_player_results(self.redis, PLAYER_ID, [match("EUW_1", 100)])
+
+        result = await self.filter_matches(key_service.get_cache_key(PLAYER_ID), ["EUW_1"])
+        self.assertEqual(result, {"existing": [match("EUW_1", 100)], "missing_ids": []})
+
+
+class MigrationTests(unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        self.cache_key = key_service.get_cache_key(PLAYER_ID)
+
+    def test_legacy_zset_becomes_blob_with_same_ttl(self):
+        matches = [match("EUW_2", 200), match("EUW_1", 100)]
+        self.redis.zadd(self.cache_key, {orjson.dumps(m): m["timestamp"] for m in matches})
+        self.redis.expire(self.cache_key, 1000)
+
+        self.assertTrue(redis_service.migrate_legacy_cache_entry(self.redis, self.cache_key))
+        cached = self.redis.get(self.cache_key)
+        self.assertTrue(cached.startswith(redis_service.CACHE_BLOB_PREFIX))
+        self.assertEqual(orjson.loads(redis_service._cache_value_to_json(cached)), matches)
+        self.assertGreater(self.redis.ttl(self.cache_key), 900)
+
+    def test_current_entries_are_left_alone(self):
+        blob = redis_service._compress_cache_json(orjson.dumps([match("EUW_1", 100)]))
+        self.redis.set(self.cache_key, blob)
+
+        self.assertFalse(redis_service.migrate_legacy_cache_entry(self.redis, self.cache_key))
+        self.assertEqual(self.redis.get(self.cache_key), blob)
+
+
+class LockTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.redis = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())
+        self.lock_key = key_service.get_lock_key(PLAYER_ID)
+        self.cooldown_key = key_service.get_cooldown_key(PLAYER_ID)
+
+    async def asyncTearDown(self):
+        await self.redis.aclose()
+
+    async def acquire(self) -> tuple[str, int]:
+        return await redis_service.acquire_update_lock(
+            self.redis, self.cooldown_key, self.lock_key, config.LOCK_TIMEOUT_SECONDS
+        )
+
+    async def test_lock_is_taken_once(self):
+        self.assertEqual(await self.acquire(), ("acquired", 0))
+        self.assertEqual(await self.acquire(), ("in_progress", 0))
+
+    async def test_running_job_wins_over_cooldown(self):
+        await self.redis.set(self.cooldown_key, "1", ex=60)
+        await self.redis.set(self.lock_key, "1")
+        self.assertEqual(await self.acquire(), ("in_progress", 0))
+
+    async def test_release_sets_cooldown_and_announces_done(self):
+        done_channel = key_service.get_done_channel(PLAYER_ID)
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(done_channel)
+        await pubsub.get_message(timeout=1)  # subscribe confirmation
+        await self.acquire()
+
+        await redis_service.release_lock_and_set_cooldown(
+            self.redis, self.lock_key, self.cooldown_key, 60, done_channel
+        )
+
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+        self.assertEqual(message["data"], b"done")
+        self.assertFalse(await self.redis.exists(self.lock_key))
+        state, ttl = await self.acquire()
+        self.assertEqual(state, "cooldown")
+        self.assertGreater(ttl, 0)
+        await pubsub.aclose()
+
+    async def test_renew_lock_only_raises_ttl_of_held_lock(self):
+        await self.redis.set(self.lock_key, "1", ex=100)
+
+        self.assertTrue(await redis_service.renew_lock(self.redis, self.lock_key, 300))
+        self.assertGreater(await self.redis.ttl(self.lock_key), 100)
+        self.assertFalse(await redis_service.renew_lock(self.redis, self.lock_key, 50))
+        self.assertGreater(await self.redis.ttl(self.lock_key), 100)
+
+        await self.redis.delete(self.lock_key)
+        self.assertFalse(await redis_service.renew_lock(self.redis, self.lock_key, 300))
+        self.assertFalse(await self.redis.exists(self.lock_key))
+
+    async def test_riot_token_budget_is_enforced(self):
+        with mock.patch.object(config, "RIOT_RATE_LIMIT_MAX_REQUESTS", 3):
+            waits = [await redis_service.acquire_riot_token(self.redis) for _ in range(4)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertGreater(waits[3], 0)
+        self.assertLessEqual(waits[3], config.RIOT_RATE_LIMIT_WINDOW_MS)
+
+
+if __name__ == "__main__":
+    unittest.main()
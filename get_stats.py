@@ -1,11 +1,14 @@
-import requests
+import asyncio
+import httpx
 import pyperclip
 import json
 import time
 
 # --- Configuration ---
 # This script assumes the League of Legends client is running and you are in a game.
-# Pip install requirements: pip install requests pyperclip
+# Pip install requirements: pip install httpx pyperclip
+
+LIVE_CLIENT_URL = "https://127.0.0.1:2999/liveclientdata"
 
 # --- Improved Reusable Prompt ---
 # This prompt is designed to force a concise, actionable response with no "bloat".
@@ -52,48 +55,49 @@ Game State Data:
 {summarized_game_json}
 """
 
-def get_live_game_data():
-    """Fetches all necessary data from the Riot Live Client Data API."""
+async def get_live_game_data():
+    """Fetches all necessary data from the Riot Live Client Data API, requesting the three endpoints concurrently."""
     try:
-        # The API uses a self-signed certificate, so we disable warnings.
-        requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
-
-        player_list = requests.get('https://127.0.0.1:2999/liveclientdata/playerlist', verify=False).json()
-        game_stats = requests.get('https://127.0.0.1:2999/liveclientdata/gamestats', verify=False).json()
-        active_player = requests.get('https://127.0.0.1:2999/liveclientdata/activeplayer', verify=False).json()
-        
+        # The API uses a self-signed certificate, so verification is disabled.
+        async with httpx.AsyncClient(base_url=LIVE_CLIENT_URL, verify=False) as client:
+            responses = await asyncio.gather(
+                client.get('/playerlist'),
+                client.get('/gamestats'),
+                client.get('/activeplayer'),
+            )
+        player_list, game_stats, active_player = (response.json() for response in responses)
         return player_list, game_stats, active_player
 
-    except requests.exceptions.RequestException as e:
+    # requests raised non-JSON bodies as a RequestException too; httpx leaves them as ValueError.
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
         print("Error connecting to the League client API. Is a game running?")
         return None, None, None
 
-def summarize_game_data(player_list, active_summoner_name):
+def summarize_game_data(player_list, active_player_team):
     """
     Creates a clean and highly concise summary of the game state,
-    including the keystone rune.
+    including the keystone rune, split by the active player's team.
     """
     summary = {
         "myTeam": [],
         "enemyTeam": []
     }
-    
-    active_player_team = next((p.get('team') for p in player_list if p.get('summonerName') == active_summoner_name), None)
-        
+
     if not active_player_team:
         return None
 
     for player in player_list:
         # Safely access the keystone rune's display name
-        keystone_rune = player.get('runes', {}).get('keystone', {}).get('displayName', 'N/A')
+        keystone = (player.get('runes') or {}).get('keystone') or {}
+        scores = player['scores']
 
         # Using abbreviated keys for conciseness
         player_summary = {
             "c": player.get('championName'),       # champion
             "p": player.get('position'),           # position
-            "r": keystone_rune,                    # keystone rune
-            "kda": f"{player['scores']['kills']}/{player['scores']['deaths']}/{player['scores']['assists']}",
-            "cs": player['scores']['creepScore'],
+            "r": keystone.get('displayName', 'N/A'), # keystone rune
+            "kda": f"{scores['kills']}/{scores['deaths']}/{scores['assists']}",
+            "cs": scores['creepScore'],
             "i": [item['displayName'] for item in player['items']] # items
         }
         
@@ -106,7 +110,7 @@ def summarize_game_data(player_list, active_summoner_name):
 def main():
     """Main function to fetch data, format the prompt, and copy it."""
     print("🎯 Attempting to fetch live game data...")
-    player_list, game_stats, active_player = get_live_game_data()
+    player_list, game_stats, active_player = asyncio.run(get_live_game_data())
 
     if not all([player_list, game_stats, active_player]):
         print("Could not retrieve game data. Exiting.")
@@ -116,19 +120,18 @@ def main():
     print("✅ Successfully fetched game data.")
     
     # --- Data Processing ---
+    # Find the active player's entry once; it gives both their champion and team.
     active_summoner_name = active_player.get('summonerName')
-    active_champion_name = 'Unknown'
-    for p in player_list:
-        if p.get('summonerName') == active_summoner_name:
-            active_champion_name = p.get('championName')
-            break
+    active_entry = next((p for p in player_list if p.get('summonerName') == active_summoner_name), None)
+    active_champion_name = active_entry.get('championName') if active_entry else 'Unknown'
 
-    summarized_data = summarize_game_data(player_list, active_summoner_name)
+    summarized_data = summarize_game_data(player_list, active_entry.get('team') if active_entry else None)
     if not summarized_data:
         print("Could not process player data correctly.")
         return
 
-    summarized_game_json = json.dumps(summarized_data)
+    # Compact separators keep the pasted prompt as short as possible.
+    summarized_game_json = json.dumps(summarized_data, separators=(",", ":"))
 
     game_time_seconds = game_stats.get('gameTime', 0)
     minutes, seconds = divmod(int(game_time_seconds), 60)